@@ -0,0 +1,168 @@
+import asyncio
+import datetime
+import json
+import os
+import sqlite3
+import threading
+from typing import AsyncIterator
+
+from config import *
+from logger import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    channel TEXT NOT NULL,
+    user TEXT NOT NULL,
+    created_at INTEGER NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_channel_time
+    ON messages (channel, created_at, user);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (created_at);
+CREATE TABLE IF NOT EXISTS sync_state (
+    channel TEXT PRIMARY KEY,
+    last_id INTEGER NOT NULL,
+    last_at INTEGER NOT NULL
+);
+"""
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def to_timestamp(dt: datetime.datetime) -> int:
+    """Unix seconds of a UTC datetime, naive ones are taken as UTC."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+
+def from_timestamp(timestamp: int) -> datetime.datetime:
+    """Naive UTC datetime, as the message timestamps were always stored."""
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).replace(
+        tzinfo=None
+    )
+
+
+class MessageArchive:
+    """
+    Clip messages of every channel in SQLite, indexed by channel and time.
+
+    Messages are keyed by channel, time and author like the former all.json
+    (channel -> user -> timestamp -> content), which is imported once if the
+    store is empty. The per-channel sync high-water marks live in the same
+    database, so they are committed together with the messages they cover.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+        self._import_json()
+
+    def _import_json(self) -> None:
+        json_path = os.path.join(OUTPUT_TEXT_PATH, "all.json")
+        state_path = os.path.join(OUTPUT_TEXT_PATH, "all_sync.json")
+        if not os.path.exists(json_path) or not self.is_empty():
+            return
+        with open(json_path, "r", encoding="utf-8") as f:
+            data: dict[str, dict[str, dict[str, str]]] = json.load(f)
+        rows = [
+            (
+                channel,
+                user,
+                to_timestamp(datetime.datetime.strptime(ts, TIMESTAMP_FORMAT)),
+                content,
+            )
+            for channel, users in data.items()
+            for user, msgs in users.items()
+            for ts, content in msgs.items()
+        ]
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf-8") as f:
+                for channel, mark in json.load(f).items():
+                    last_at = datetime.datetime.strptime(
+                        mark["last_at"], TIMESTAMP_FORMAT
+                    )
+                    state[channel] = (mark["last_id"], to_timestamp(last_at))
+        self.add(rows, state)
+        logger.info(f"imported {len(rows)} messages from {json_path}")
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            return (
+                self._conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None
+            )
+
+    def add(
+        self,
+        rows: list[tuple[str, str, int, str]],
+        state: dict[str, tuple[int, int]] | None = None,
+    ) -> None:
+        """
+        Store (channel, user, created_at, content) rows and move the given
+        channels' high-water marks to (last message id, last created_at).
+        """
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO messages (channel, user, created_at, content)"
+                " VALUES (?, ?, ?, ?) ON CONFLICT (channel, created_at, user)"
+                " DO UPDATE SET content = excluded.content",
+                rows,
+            )
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sync_state (channel, last_id, last_at)"
+                " VALUES (?, ?, ?)",
+                [(channel, *mark) for channel, mark in (state or {}).items()],
+            )
+
+    def sync_state(self) -> dict[str, tuple[int, int]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT channel, last_id, last_at FROM sync_state"
+            ).fetchall()
+        return {channel: (last_id, last_at) for channel, last_id, last_at in rows}
+
+    def latest(self, channel: str) -> int | None:
+        with self._lock:
+            (latest,) = self._conn.execute(
+                "SELECT MAX(created_at) FROM messages WHERE channel = ?", (channel,)
+            ).fetchone()
+        return latest
+
+    def _page(
+        self, channel: str, after: tuple[int, int], limit: int
+    ) -> list[tuple[int, int, str, str]]:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT id, created_at, user, content FROM messages"
+                " WHERE channel = ? AND (created_at, id) > (?, ?)"
+                " ORDER BY created_at, id LIMIT ?",
+                (channel, *after, limit),
+            ).fetchall()
+
+    async def channel_messages(
+        self, channel: str, start: int | None = None, page_size: int = 1000
+    ) -> AsyncIterator[tuple[int, str, str]]:
+        """
+        Lazily yield (created_at, user, content) of `channel` from `start` on,
+        in time order. Pages are fetched by keyset on the (channel,
+        created_at) index in a worker thread, so stopping early never reads
+        the rest and the event loop never waits on the database.
+        """
+        # ids start at 1, so (start, 0) includes every message at `start`
+        after = (start if start is not None else -(2**63), 0)
+        while True:
+            rows = await asyncio.to_thread(self._page, channel, after, page_size)
+            for _, created_at, user, content in rows:
+                yield created_at, user, content
+            if len(rows) < page_size:
+                return
+            last_id, last_at = rows[-1][0], rows[-1][1]
+            after = (last_at, last_id)
+
+
+message_archive = MessageArchive(os.path.join(OUTPUT_TEXT_PATH, "archive.sqlite3"))
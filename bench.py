@@ -0,0 +1,358 @@
+"""
+Stage-level pipeline benchmark on synthetic media.
+
+Clips and BGM tracks are generated with ffmpeg's lavfi sources, served by a
+local stand-in for outplayed.tv, and pushed through every pipeline stage in
+an isolated workspace. Per-stage timings are printed as JSON:
+
+    python bench.py --clips 8 --duration 30 --output bench.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from dotenv import dotenv_values
+
+REPO_PATH = os.path.dirname(os.path.abspath(__file__))
+# clips alternate between these, as recorded by different players
+RESOLUTIONS = ["1920x1080", "2560x1440", "1280x720"]
+PAGE_FILLER = "<div class='filler'>" + "x" * 4096 + "</div>\n"
+
+
+def prepare_workspace(workdir: str) -> None:
+    """
+    Write a .env that points every data directory into `workdir` and chdir
+    there, so the pipeline modules pick it up when they are imported.
+    """
+    config = dotenv_values(os.path.join(REPO_PATH, ".env"))
+    for key in ("FONT_FILE_PATH",):
+        if config.get(key):
+            config[key] = os.path.abspath(os.path.join(REPO_PATH, config[key]))
+    for key, sub_path in (
+        ("VIDEO_PATH", "videos"),
+        ("AUDIO_PATH", "audio"),
+        ("OUTPUT_VIDEO_PATH", "output/videos"),
+        ("OUTPUT_IMAGE_PATH", "output/images"),
+        ("OUTPUT_AUDIO_PATH", "output/audio"),
+        ("OUTPUT_TEXT_PATH", "output/text"),
+        ("CACHE_PATH", "output/cache"),
+        ("TRACE_PATH", "output/trace"),
+    ):
+        config[key] = os.path.join(workdir, sub_path)
+    os.makedirs(workdir, exist_ok=True)
+    with open(os.path.join(workdir, ".env"), "w", encoding="utf-8") as f:
+        for key, value in config.items():
+            f.write(f"{key}={value or ''}\n")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_PATH)
+
+
+def summarize(wall: float, items: list[float]) -> dict:
+    summary = {"wall": round(wall, 4), "count": len(items)}
+    if items:
+        summary.update(
+            total=round(sum(items), 4),
+            mean=round(statistics.mean(items), 4),
+            p50=round(statistics.median(items), 4),
+            max=round(max(items), 4),
+        )
+    return summary
+
+
+async def _timed(coro):
+    start = time.perf_counter()
+    value = await coro
+    return value, time.perf_counter() - start
+
+
+async def run_stage(report: dict, name: str, coros: list) -> list:
+    """Run `coros` concurrently, recording wall time and per-item times."""
+    print(f"running {name} ({len(coros)} items)...", file=sys.stderr)
+    start = time.perf_counter()
+    outcomes = await asyncio.gather(*(_timed(coro) for coro in coros))
+    report[name] = summarize(
+        time.perf_counter() - start, [seconds for _, seconds in outcomes]
+    )
+    return [value for value, _ in outcomes]
+
+
+async def generate_clip(path: str, duration: float, size: str) -> None:
+    from utils import run_ffmpeg
+
+    await run_ffmpeg(
+        [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"testsrc2=size={size}:rate=60:duration={duration}",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency=440:sample_rate=48000:duration={duration}",
+            "-c:v",
+            "libx264",
+            "-preset",
+            "veryfast",
+            "-pix_fmt",
+            "yuv420p",
+            "-c:a",
+            "aac",
+            "-shortest",
+            path,
+        ]
+    )
+
+
+async def generate_bgm(path: str, duration: float, frequency: int) -> None:
+    from utils import run_ffmpeg
+
+    await run_ffmpeg(
+        [
+            "ffmpeg",
+            "-y",
+            "-f",
+            "lavfi",
+            "-i",
+            f"sine=frequency={frequency}:sample_rate=44100:duration={duration}",
+            "-c:a",
+            "libmp3lame",
+            path,
+        ]
+    )
+
+
+async def start_server(media_path: str):
+    """Serve outplayed.tv-like pages at /clip/<n> and their mp4s at /media/."""
+    from aiohttp import web
+
+    async def page(request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        if not os.path.exists(os.path.join(media_path, f"{name}.mp4")):
+            raise web.HTTPNotFound()
+        body = (
+            "<html><head><title>outplayed</title></head><body>\n"
+            + PAGE_FILLER * 8
+            + f'<video class="player" src="/media/{name}.mp4"></video>\n'
+            + PAGE_FILLER * 32
+            + "</body></html>"
+        )
+        return web.Response(text=body, content_type="text/html")
+
+    app = web.Application()
+    app.router.add_get("/clip/{name}", page)
+    app.router.add_static("/media/", media_path)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def host_info() -> dict:
+    from encoders import get_encoder_backend
+
+    try:
+        ffmpeg_version = subprocess.run(
+            ["ffmpeg", "-version"], capture_output=True, text=True
+        ).stdout.split("\n")[0]
+    except FileNotFoundError:
+        ffmpeg_version = ""
+    return {
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": ffmpeg_version,
+        "encoder_backend": get_encoder_backend("hevc").name,
+    }
+
+
+async def bench(args: argparse.Namespace, workdir: str) -> dict:
+    import aiohttp
+
+    from config import (
+        AUDIO_PATH,
+        OUTPUT_AUDIO_PATH,
+        OUTPUT_IMAGE_PATH,
+        OUTPUT_VIDEO_PATH,
+        VIDEO_PATH,
+    )
+    from cover import create_cover_image
+    from utils import (
+        clip_filename,
+        download_video,
+        extract_video_url,
+        get_media_duration,
+        merge_audios,
+        merge_videos_with_bgm,
+        probe_media,
+        process_video,
+        render_graph,
+    )
+
+    report: dict = {}
+    media_path = os.path.join(workdir, "origin")
+    os.makedirs(media_path, exist_ok=True)
+    names = [f"clip{i:03d}" for i in range(args.clips)]
+    await run_stage(
+        report,
+        "generate_clips",
+        [
+            generate_clip(
+                os.path.join(media_path, f"{name}.mp4"),
+                args.duration,
+                RESOLUTIONS[i % len(RESOLUTIONS)],
+            )
+            for i, name in enumerate(names)
+        ],
+    )
+    await run_stage(
+        report,
+        "generate_bgm",
+        [
+            generate_bgm(
+                os.path.join(AUDIO_PATH, f"bgm{i:02d}.mp3"),
+                args.bgm_duration,
+                220 + 110 * i,
+            )
+            for i in range(args.bgm_tracks)
+        ],
+    )
+
+    runner, base_url = await start_server(media_path)
+    try:
+        page_urls = [f"{base_url}/clip/{name}" for name in names]
+        async with aiohttp.ClientSession() as session:
+            video_urls = await run_stage(
+                report,
+                "extract_video_url",
+                [extract_video_url(url, session) for url in page_urls],
+            )
+            await run_stage(
+                report,
+                "extract_video_url_cached",
+                [extract_video_url(url, session) for url in page_urls],
+            )
+            fns = [clip_filename(url) for url in page_urls]
+            await run_stage(
+                report,
+                "download_video",
+                [
+                    download_video(video_url, os.path.join(VIDEO_PATH, fn), session)
+                    for video_url, fn in zip(video_urls, fns)
+                ],
+            )
+    finally:
+        await runner.cleanup()
+
+    paths = [os.path.join(VIDEO_PATH, fn) for fn in fns]
+    await run_stage(
+        report,
+        "probe_media",
+        [asyncio.to_thread(probe_media, path) for path in paths],
+    )
+    durations = await run_stage(
+        report,
+        "get_media_duration",
+        [asyncio.to_thread(get_media_duration, path) for path in paths],
+    )
+    total_duration = sum(durations)
+    texts = [f"@bench\nclip {i}" for i in range(len(fns))]
+    processed_fns = await run_stage(
+        report,
+        "process_video",
+        [process_video(fn, text) for fn, text in zip(fns, texts)],
+    )
+    await run_stage(
+        report,
+        "process_video_cached",
+        [process_video(fn, text) for fn, text in zip(fns, texts)],
+    )
+    (audio_path,) = await run_stage(
+        report,
+        "merge_audios",
+        [merge_audios(os.path.join(OUTPUT_AUDIO_PATH, "bench.m4a"), total_duration)],
+    )
+    await run_stage(
+        report,
+        "merge_videos_with_bgm",
+        [
+            merge_videos_with_bgm(
+                processed_fns,
+                os.path.join(OUTPUT_VIDEO_PATH, "bench.mp4"),
+                audio_path,
+            )
+        ],
+    )
+    await run_stage(
+        report,
+        "render_graph",
+        [render_graph(fns, texts, os.path.join(OUTPUT_VIDEO_PATH, "bench_graph.mp4"))],
+    )
+    await run_stage(
+        report,
+        "create_cover_image",
+        [create_cover_image(paths, os.path.join(OUTPUT_IMAGE_PATH, "bench.png"))],
+    )
+    return {
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": host_info(),
+        "params": {
+            "clips": args.clips,
+            "duration": args.duration,
+            "bgm_tracks": args.bgm_tracks,
+            "bgm_duration": args.bgm_duration,
+            "video_seconds": round(total_duration, 3),
+        },
+        "stages": report,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--clips", type=int, default=6, help="number of clips")
+    parser.add_argument("--duration", type=float, default=20, help="seconds per clip")
+    parser.add_argument("--bgm-tracks", type=int, default=3)
+    parser.add_argument(
+        "--bgm-duration", type=float, default=90, help="seconds per bgm track"
+    )
+    parser.add_argument(
+        "--workdir", help="workspace directory, a temporary one by default"
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the temporary workspace"
+    )
+    parser.add_argument("--output", help="write the JSON report to this file")
+    args = parser.parse_args()
+
+    if args.output:
+        args.output = os.path.abspath(args.output)
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix="acd-bench-"))
+    prepare_workspace(workdir)
+    try:
+        result = asyncio.run(bench(args, workdir))
+    finally:
+        os.chdir(REPO_PATH)
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    output = json.dumps(result, indent=4)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,8 +4,6 @@ import subprocess
 from logger import logger
 from utils import subprocess_run
 
-subprocess.run = subprocess_run
-
 
 def upload_video(video_path: str, image_path: str, title: str) -> str:
     """
@@ -33,7 +31,7 @@ def upload_video(video_path: str, image_path: str, title: str) -> str:
 
     try:
         # The subprocess_run in utils.py will log the command.
-        result = subprocess.run(
+        result = subprocess_run(
             command,
             check=True,
             text=True,
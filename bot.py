@@ -1,15 +1,24 @@
 import asyncio
+import contextlib
 import datetime
-import hashlib
 import json
 import os
 import traceback
+from typing import AsyncIterator
 
 import disnake
-from disnake.ext import commands
+from disnake.ext import commands, tasks
 
+from archive import from_timestamp, message_archive, to_timestamp
 from config import *
+from cover import create_cover_image
+from downloader import downloader
 from logger import logger
+from progress import ProgressReporter, format_seconds
+from scheduler import *
+from storage import storage
+from timeline import timeline_index, timeline_key, timeline_lock
+from tracing import metrics, span, start_monitoring
 from utils import *
 
 intents = disnake.Intents.default()
@@ -49,67 +58,159 @@ async def _patched_edit_original_response(*args, **kwargs):
 disnake.Interaction.edit_original_response = _patched_edit_original_response
 
 
-async def collect_messages(hours: int = 72) -> dict[str, list[dict[str, str]]]:
-    today = datetime.datetime.now()
-    ago = today - datetime.timedelta(hours=hours)
+async def collect_messages(hours: int = 72) -> AsyncIterator[tuple[int, str, str]]:
+    """
+    Yield (index in CHANNELS, author, content) of every clip message posted
+    in the configured channels within `hours`, as soon as it is fetched.
+
+    Channels are paged concurrently, disnake keeps each within its rate limit
+    bucket. Messages of one channel arrive in order, oldest first.
+    """
+    ago = datetime.datetime.now() - datetime.timedelta(hours=hours)
     guild = bot.get_guild(RUN_GUILD)
-    res: dict[str, list[dict[str, str]]] = {}
     if not guild:
         logger.error("Guild not found")
-        return res
-    for category in guild.categories:
-        if category.name != CATEGORY:
-            continue
-        for channel in category.text_channels:
-            messages = await channel.history(after=ago).flatten()
-            items = []
-            for msg in messages:
+        return
+    channels = {
+        channel.name: channel
+        for channel in guild.text_channels
+        if channel.category is not None
+        and channel.category.name == CATEGORY
+        and channel.name in CHANNELS
+    }
+    for name in CHANNELS:
+        if name not in channels:
+            logger.warning(f"channel {name} not found in category {CATEGORY}")
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def scan(index: int, channel: disnake.TextChannel) -> None:
+        try:
+            async for msg in channel.history(after=ago):
                 url = extract_url_with_prefix(msg.content, "https://outplayed.tv")
                 if not url:
                     continue
                 if any(reaction.emoji in DENY_EMOJIS for reaction in msg.reactions):
                     continue
-                items.append({msg.author.display_name: msg.content})
-            res[channel.name] = items
-    return res
-
-
-async def fetch_one_year_msg() -> None:
-    today = datetime.datetime.now()
-    res: dict[str, dict[str, dict[str, str]]] = {}
-    msg_count = 0
-    for i in range(365, -1, -1):
-        after = today - datetime.timedelta(hours=24 * (i + 1))
-        before = today - datetime.timedelta(hours=24 * i)
+                queue.put_nowait((index, msg.author.display_name, msg.content))
+        finally:
+            queue.put_nowait(done)
+
+    fetchers = [
+        asyncio.create_task(scan(index, channels[name]))
+        for index, name in enumerate(CHANNELS)
+        if name in channels
+    ]
+    try:
+        remaining = len(fetchers)
+        while remaining:
+            item = await queue.get()
+            if item is done:
+                remaining -= 1
+                continue
+            yield item
+        # surface scan errors once every channel has finished
+        await asyncio.gather(*fetchers)
+    finally:
+        for fetcher in fetchers:
+            fetcher.cancel()
+
+
+archive_lock = asyncio.Lock()
+
+
+def _dump_json(obj, path: str, **kwargs) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, **kwargs)
+    os.replace(tmp_path, path)
+
+
+async def sync_message_archive(days: int = 366) -> int:
+    """
+    Add messages newer than each channel's high-water mark to the archive.
+
+    The mark (last message id and time) is stored per channel with the
+    messages, so every sync pages forward once from where the previous one
+    stopped. Without a mark, the newest archived message of the channel is
+    used, or `days` ago for a channel that was never archived.
+    """
+    async with archive_lock:
         guild = bot.get_guild(RUN_GUILD)
         if not guild:
             logger.error("Guild not found")
-            return
+            return 0
+        state = await asyncio.to_thread(message_archive.sync_state)
+        first = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+            days=days
+        )
+        msg_count = 0
         for category in guild.categories:
             if category.name != CATEGORY:
                 continue
             for channel in category.text_channels:
-                if channel.name not in res:
-                    res[channel.name] = {}
-                messages = await channel.history(after=after, before=before).flatten()
-                for msg in messages:
+                after: datetime.datetime | disnake.Object = first
+                if channel.name in state:
+                    after = disnake.Object(id=state[channel.name][0])
+                elif latest := await asyncio.to_thread(
+                    message_archive.latest, channel.name
+                ):
+                    after = datetime.datetime.fromtimestamp(
+                        latest, datetime.timezone.utc
+                    )
+                rows: list[tuple[str, str, int, str]] = []
+                mark: dict[str, tuple[int, int]] = {}
+                async for msg in channel.history(
+                    limit=None, after=after, oldest_first=True
+                ):
+                    created_at = to_timestamp(msg.created_at)
+                    mark = {channel.name: (msg.id, created_at)}
                     url = extract_url_with_prefix(msg.content, "https://outplayed.tv")
-                    if not url:
-                        continue
-                    if any(reaction.emoji in DENY_EMOJIS for reaction in msg.reactions):
-                        continue
-                    if msg.author.display_name not in res[channel.name]:
-                        res[channel.name][msg.author.display_name] = {}
-                    res[channel.name][msg.author.display_name][
-                        msg.created_at.strftime("%Y-%m-%d %H:%M:%S")
-                    ] = msg.content
-                    msg_count += 1
-    json.dump(
-        res,
-        open(os.path.join(OUTPUT_TEXT_PATH, f"all.json"), "w"),
-        ensure_ascii=False,
-        indent=4,
-    )
+                    if url and not any(
+                        reaction.emoji in DENY_EMOJIS for reaction in msg.reactions
+                    ):
+                        rows.append(
+                            (
+                                channel.name,
+                                msg.author.display_name,
+                                created_at,
+                                msg.content,
+                            )
+                        )
+                        msg_count += 1
+                    if len(rows) >= ARCHIVE_BATCH_SIZE:
+                        await asyncio.to_thread(message_archive.add, rows, mark)
+                        rows = []
+                if rows or mark:
+                    await asyncio.to_thread(message_archive.add, rows, mark)
+    logger.info(f"synced {msg_count} new messages into the archive")
+    return msg_count
+
+
+@tasks.loop(hours=ARCHIVE_SYNC_HOURS or 24)
+async def archive_sync_loop():
+    try:
+        await sync_message_archive()
+    except Exception as e:
+        logger.exception(f"Error syncing message archive: {e}")
+
+
+@tasks.loop(minutes=STORAGE_SWEEP_MINUTES)
+async def storage_sweep_loop():
+    try:
+        freed = await asyncio.to_thread(storage.sweep)
+        if freed:
+            logger.info(f"storage sweep freed {freed / 1024**2:.1f} MiB")
+    except Exception as e:
+        logger.exception(f"Error sweeping storage: {e}")
+
+
+@tasks.loop(seconds=CACHE_FLUSH_SECONDS)
+async def cache_flush_loop():
+    try:
+        await flush_caches()
+    except Exception as e:
+        logger.exception(f"Error flushing caches: {e}")
 
 
 async def create_and_upload_final_video(
@@ -118,63 +219,152 @@ async def create_and_upload_final_video(
     fns: list[str],
     output_fn: str,
     title: str = "",
-    force_process: bool = False,
+    reporter: ProgressReporter | None = None,
 ) -> None:
-    if len(texts) == 0:
-        await inter.edit_original_response("no messages found for videos")
-        return ""
-    if title == "":
-        title = output_fn
-    await inter.edit_original_response(f"processing {len(texts)} videos...")
-    video_durations = []
-    for i, (text, fn) in enumerate(zip(texts, fns)):
-        await inter.edit_original_response(f"processing videos... {i+1}/{len(texts)}")
-        if (
-            not os.path.exists(os.path.join(OUTPUT_VIDEO_PATH, "tmp", fn))
-            or force_process
-        ):
-            await asyncio.to_thread(process_video, fn, text)
-        video_durations.append(
-            await asyncio.to_thread(get_media_duration, os.path.join(VIDEO_PATH, fn))
+    if reporter is not None:
+        await _create_and_upload_final_video(
+            inter, reporter, texts, fns, output_fn, title
+        )
+        return
+    async with ProgressReporter(inter) as reporter:
+        await _create_and_upload_final_video(
+            inter, reporter, texts, fns, output_fn, title
+        )
+
+
+def _percent_progress(reporter: ProgressReporter, stage: str, total_duration: float):
+    def on_progress(event: dict) -> None:
+        if event["out_time"] and total_duration > 0:
+            percent = min(event["out_time"] / total_duration, 1) * 100
+            reporter.update(f"{stage}... {percent:.0f}%")
+
+    return on_progress
+
+
+async def _render_segments(
+    reporter: ProgressReporter,
+    texts: list[str],
+    fns: list[str],
+    output_fn: str,
+    output_path: str,
+    total_duration: float,
+) -> str:
+    # the playlist only depends on the total duration, build it during encodes
+    audio_task = asyncio.create_task(
+        merge_audios(
+            os.path.join(OUTPUT_AUDIO_PATH, "tmp", f"{output_fn}.m4a"),
+            total_duration,
         )
-    logger.info(f"total video duration: {sum(video_durations)}")
-    await inter.edit_original_response("merging audios...")
-    audio_path = await asyncio.to_thread(
-        merge_audios,
-        os.path.join(OUTPUT_AUDIO_PATH, "tmp", f"{output_fn}.m4a"),
-        sum(video_durations),
     )
-    await inter.edit_original_response("merging videos with bgm...")
-    video_path = await asyncio.to_thread(
-        merge_videos_with_bgm,
+    # the same variant may appear twice, it must not be encoded twice concurrently
+    process_tasks: dict[tuple[str, str], asyncio.Task] = {}
+    for text, fn in zip(texts, fns):
+        if (fn, text) not in process_tasks:
+            process_tasks[(fn, text)] = asyncio.create_task(process_video(fn, text))
+    reporter.stage("processing videos", len(process_tasks))
+    try:
+        for future in asyncio.as_completed(process_tasks.values()):
+            await future
+            reporter.advance()
+        processed_fns = [
+            process_tasks[(fn, text)].result() for text, fn in zip(texts, fns)
+        ]
+        audio_path = await audio_task
+    finally:
+        audio_task.cancel()
+        for task in process_tasks.values():
+            task.cancel()
+    reporter.update("merging videos with bgm...")
+    on_merge_progress = _percent_progress(
+        reporter, "merging videos with bgm", total_duration
+    )
+    return await merge_videos_with_bgm(
+        processed_fns, output_path, audio_path, on_progress=on_merge_progress
+    )
+
+
+async def _render_graph(
+    reporter: ProgressReporter,
+    texts: list[str],
+    fns: list[str],
+    output_path: str,
+    total_duration: float,
+) -> str:
+    reporter.update("rendering video...")
+    return await render_graph(
         fns,
-        os.path.join(OUTPUT_VIDEO_PATH, f"{output_fn}.mp4"),
-        audio_path,
+        texts,
+        output_path,
+        on_progress=_percent_progress(reporter, "rendering video", total_duration),
     )
-    image_path = await asyncio.to_thread(
-        create_cover_image,
-        os.path.join(VIDEO_PATH, fns[0]),
-        os.path.join(OUTPUT_IMAGE_PATH, f"{output_fn}.png"),
+
+
+async def _create_and_upload_final_video(
+    inter: disnake.ApplicationCommandInteraction,
+    reporter: ProgressReporter,
+    texts: list[str],
+    fns: list[str],
+    output_fn: str,
+    title: str,
+) -> None:
+    if len(texts) == 0:
+        await reporter.send_now("no messages found for videos")
+        return
+    if title == "":
+        title = output_fn
+    # identical commands may run at once, each job renders to its own files
+    output_fn = f"{output_fn}-{inter.id}"
+
+    # stages only wait for their own inputs: the cover needs the source clips,
+    # the bgm the total duration, which the media info cache already knows
+    cover_task = asyncio.create_task(
+        create_cover_image(
+            [os.path.join(VIDEO_PATH, fn) for fn in fns],
+            os.path.join(OUTPUT_IMAGE_PATH, f"{output_fn}.png"),
+        )
     )
-    duration = await asyncio.to_thread(get_media_duration, video_path)
-
-    def format_seconds(seconds):
-        hours = int(seconds // 3600)
-        minutes = int((seconds % 3600) // 60)
-        secs = int(seconds % 60)
-        if hours == 0:
-            if minutes == 0:
-                return f"{secs:02d}s"
-            return f"{minutes:02d}:{secs:02d}"
-        return f"{hours:02d}:{minutes:02d}:{secs:02d}"
-
-    await inter.edit_original_response(
+    try:
+        durations = await asyncio.gather(
+            *(
+                asyncio.to_thread(get_media_duration, os.path.join(VIDEO_PATH, fn))
+                for fn in fns
+            )
+        )
+        duration = sum(durations)
+        logger.info(f"total video duration: {duration}")
+        output_path = os.path.join(OUTPUT_VIDEO_PATH, f"{output_fn}.mp4")
+        graph = RENDER_MODE == "graph" and len(fns) <= RENDER_GRAPH_MAX_CLIPS
+        with span(
+            "render",
+            mode="graph" if graph else "segments",
+            clips=len(fns),
+            seconds=duration,
+        ):
+            if graph:
+                video_path = await _render_graph(
+                    reporter, texts, fns, output_path, duration
+                )
+            else:
+                video_path = await _render_segments(
+                    reporter, texts, fns, output_fn, output_path, duration
+                )
+        image_path = await cover_task
+    finally:
+        cover_task.cancel()
+    reporter.update(
         f"uploading the final video ({format_seconds(duration)}) with title {title}..."
     )
     channel = bot.get_channel(inter.channel_id) or await bot.fetch_channel(
         inter.channel_id
     )
     logger.info(f"Uploading video {video_path} with title {title}")
+    video_size = os.path.getsize(video_path)
+
+    def on_upload_progress(sent: int, total: int, rate: float) -> None:
+        reporter.update(
+            f"uploading the final video ({format_seconds(duration)}) to youtube... "
+            f"{sent / total:.0%} at {rate / 1024 / 1024:.2f} MiB/s"
+        )
 
     async def youtube_worker():
         msg = "Error uploading video to YouTube. No url returned."
@@ -182,8 +372,19 @@ async def create_and_upload_final_video(
             f'running youtube.upload_video("{video_path}", "{image_path}", "{title}")'
         )
         try:
-            msg = await asyncio.to_thread(
-                youtube.upload_video, video_path, image_path, title
+            with span("upload_youtube", bytes=video_size) as upload_span:
+                async with scheduler.uploads["youtube"]:
+                    msg = await youtube.upload_video(
+                        video_path,
+                        image_path,
+                        title,
+                        on_progress=on_upload_progress,
+                        channel_id=inter.channel_id,
+                    )
+            metrics.count("upload.youtube.bytes", video_size)
+            metrics.observe(
+                "upload.youtube.bytes_per_second",
+                video_size / max(upload_span.duration, 1e-6),
             )
             if msg == "":
                 raise Exception("Upload failed, no URL returned.")
@@ -193,7 +394,7 @@ async def create_and_upload_final_video(
         if inter.is_expired():
             await channel.send(msg)
         else:
-            await inter.edit_original_response(msg)
+            await reporter.send_now(msg)
 
     async def bilibili_worker():
         msg = "Error uploading video to Bilibili. No url returned."
@@ -201,9 +402,12 @@ async def create_and_upload_final_video(
             f'running bilibili.upload_video("{video_path}", "{image_path}", "{title}")'
         )
         try:
-            msg = await asyncio.to_thread(
-                bilibili.upload_video, video_path, image_path, title
-            )
+            with span("upload_bilibili", bytes=video_size):
+                async with scheduler.uploads["bilibili"]:
+                    msg = await asyncio.to_thread(
+                        bilibili.upload_video, video_path, image_path, title
+                    )
+            metrics.count("upload.bilibili.bytes", video_size)
             if msg == "":
                 raise Exception("Upload failed, no URL returned.")
         except Exception as e:
@@ -214,9 +418,51 @@ async def create_and_upload_final_video(
     await asyncio.gather(youtube_worker(), bilibili_worker())
 
 
+async def resume_youtube_uploads() -> None:
+    """Finish YouTube uploads that were interrupted by a restart."""
+    for upload in await asyncio.to_thread(youtube.pending_uploads):
+        video_path, title = upload["video_path"], upload["title"]
+        logger.info(f"Resuming interrupted upload of {video_path}")
+        try:
+            with span("upload_youtube", resumed=True):
+                async with scheduler.uploads["youtube"]:
+                    msg = await youtube.upload_video(
+                        video_path,
+                        upload["image_path"],
+                        title,
+                        channel_id=upload["channel_id"],
+                    )
+        except Exception as e:
+            logger.exception(f"Error resuming upload: {e}")
+            msg = "Error uploading video to YouTube. Please check the logs."
+        if upload["channel_id"] is None:
+            continue
+        try:
+            channel = bot.get_channel(upload["channel_id"]) or await bot.fetch_channel(
+                upload["channel_id"]
+            )
+            await channel.send(f"{title}: {msg}")
+        except Exception as e:
+            logger.exception(f"Error reporting resumed upload: {e}")
+
+
+resume_task: asyncio.Task | None = None
+
+
 @bot.event
 async def on_ready():
     logger.info(f"We have logged in as {bot.user}")
+    await start_monitoring()
+    await asyncio.to_thread(get_encoder_backend, "hevc")
+    if ARCHIVE_SYNC_HOURS > 0 and not archive_sync_loop.is_running():
+        archive_sync_loop.start()
+    if not storage_sweep_loop.is_running():
+        storage_sweep_loop.start()
+    if not cache_flush_loop.is_running():
+        cache_flush_loop.start()
+    global resume_task
+    if resume_task is None:
+        resume_task = asyncio.create_task(resume_youtube_uploads())
 
 
 @bot.event
@@ -248,63 +494,109 @@ async def excavate(
         f"@{inter.user.display_name} /excavate minute_start:{minute_start} duration:{duration} title:{title}"
     )
     await inter.response.defer()
-    if not os.path.exists(os.path.join(OUTPUT_TEXT_PATH, "all.json")):
-        await inter.edit_original_response("fetching 1 year messages...")
-        await fetch_one_year_msg()
     minute_end = minute_start + duration
     if minute_start < 0 or duration < 0:
         await inter.edit_original_response("invalid parameters")
         return
-    output_fn = f"excavate-{minute_start}-{minute_end}"
-    data = await asyncio.to_thread(
-        json.load,
-        open(os.path.join(OUTPUT_TEXT_PATH, "all.json"), "r", encoding="utf-8"),
-    )
-    timeline_iter = create_global_timeline_iterator(data, CHANNELS)
-    texts = []
-    fns = []
-    current_duration = 0
-    idx_map = {CHANNELS[i]: i for i in range(len(CHANNELS))}
-    tmp_res: list[list[tuple[str, str]]] = [[] for _ in range(len(idx_map))]
-    first_reach = minute_start == 0
-    await inter.edit_original_response(f"checking videos lengths...")
-    for channel, dt, user, message in timeline_iter:
-        if channel not in CHANNELS:
-            continue
-        page_url = extract_url_with_prefix(message, "https://outplayed.tv/")
-        if not page_url:
-            continue
-        fn = hashlib.md5(page_url.encode()).hexdigest() + ".mp4"
-        if not os.path.exists(os.path.join(VIDEO_PATH, fn)):
-            video_url = await extract_video_url(page_url)
-            if not video_url:
-                continue
-            await download_video(video_url, os.path.join(VIDEO_PATH, fn))
-        video_duration = await asyncio.to_thread(
-            get_media_duration, os.path.join(VIDEO_PATH, fn)
+    async with (
+        ProgressReporter(inter) as reporter,
+        scheduler.job("excavate", PRIORITY_EXCAVATE, reporter),
+    ):
+        if await asyncio.to_thread(message_archive.is_empty):
+            reporter.update("fetching 1 year messages...")
+        else:
+            reporter.update("syncing new messages...")
+        await sync_message_archive()
+        output_fn = f"excavate-{minute_start}-{minute_end}"
+        texts = []
+        fns = []
+        idx_map = {CHANNELS[i]: i for i in range(len(CHANNELS))}
+        tmp_res: list[list[tuple[str, str]]] = [[] for _ in range(len(idx_map))]
+        # the timeline is merged lazily and only walked as far as the window
+        timeline = create_global_timeline_iterator(
+            message_archive.channel_messages, CHANNELS
+        )
+        entries_iter = (
+            (channel, from_timestamp(timestamp), user, message, page_url)
+            async for channel, timestamp, user, message in timeline
+            if (page_url := extract_url_with_prefix(message, "https://outplayed.tv/"))
         )
-        if video_duration == 0.0:
-            logger.warning(
-                f"video duration is 0: {os.path.join(VIDEO_PATH, fn)}, message {message}"
+        entries = []
+
+        def entry_key(entry) -> str:
+            channel, dt, _, _, page_url = entry
+            return timeline_key(channel, dt, page_url)
+
+        def probe_url(entry) -> str | None:
+            # clips whose duration is already indexed are not acquired again
+            if timeline_index.duration_of(entry_key(entry)) is not None:
+                return None
+            return entry[4]
+
+        async def resumed(pending):
+            yield pending
+            async for entry in entries_iter:
+                yield entry
+
+        async with timeline_lock, contextlib.aclosing(timeline):
+            timeline_index.reset()
+            pending = None
+            async for entry in entries_iter:
+                if not timeline_index.advance(entry_key(entry)):
+                    pending = entry
+                    break
+                entries.append(entry)
+                if timeline_index.total > minute_end * 60:
+                    break
+            if pending is not None:
+                reporter.update("checking videos lengths...")
+                async for entry, fn in downloader.acquire_ordered(
+                    resumed(pending), key=probe_url
+                ):
+                    key = entry_key(entry)
+                    if not timeline_index.advance(key):
+                        video_duration = 0.0
+                        if fn:
+                            video_duration = await asyncio.to_thread(
+                                get_media_duration, os.path.join(VIDEO_PATH, fn)
+                            )
+                        if video_duration == 0.0:
+                            logger.warning(
+                                f"video duration is 0: {fn}, message {entry[3]}"
+                            )
+                        timeline_index.append(key, video_duration)
+                    entries.append(entry)
+                    if timeline_index.total > minute_end * 60:
+                        break
+                await asyncio.to_thread(timeline_index.save)
+                await flush_caches()
+            start = timeline_index.seek(minute_start * 60)
+            if minute_start != 0:
+                # the clip crossing minute_start belongs to the previous window
+                start += 1
+            window = []
+            for i in range(start, timeline_index.indexed):
+                if timeline_index.durations[i] > 0:
+                    window.append(entries[i])
+                if timeline_index.cumulative[i] > minute_end * 60:
+                    break
+        downloaded: list[str | None] = [None] * len(window)
+        async for i, fn in downloader.acquire_many([entry[4] for entry in window]):
+            downloaded[i] = fn
+        for (channel, dt, user, message, _), fn in zip(window, downloaded):
+            if not fn:
+                continue
+            simple_msg = cleanup_msg(message)
+            tmp_res[idx_map[channel]].append(
+                ("@" + user + " " + dt.strftime("%Y-%m-%d") + "\n" + simple_msg, fn)
             )
-            continue
-        current_duration += video_duration
-        if current_duration < minute_start * 60:
-            continue
-        elif not first_reach:
-            first_reach = True
-            continue
-        simple_msg = cleanup_msg(message)
-        tmp_res[idx_map[channel]].append(
-            ("@" + user + " " + dt.strftime("%Y-%m-%d") + "\n" + simple_msg, fn)
+        for l in tmp_res:
+            for item in l:
+                texts.append(item[0])
+                fns.append(item[1])
+        await create_and_upload_final_video(
+            inter, texts, fns, output_fn, title, reporter
         )
-        if current_duration > minute_end * 60:
-            break
-    for l in tmp_res:
-        for item in l:
-            texts.append(item[0])
-            fns.append(item[1])
-    await create_and_upload_final_video(inter, texts, fns, output_fn, title)
 
 
 @bot.slash_command(description="Bake a video from messages within the last 8 hours.")
@@ -315,32 +607,46 @@ async def bake(
     current_datetime = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
     output_fn = current_datetime
     await inter.response.defer()
-    await inter.edit_original_response("extracting messages...")
-    data = await collect_messages(hours)
-    json.dump(
-        data,
-        open(os.path.join(OUTPUT_TEXT_PATH, f"{output_fn}.json"), "w"),
-        ensure_ascii=False,
-        indent=4,
-    )
-    texts = []
-    fns = []
-    items = [item for channel in CHANNELS for item in data[channel]]
-    await inter.edit_original_response(f"downloading {len(items)} videos...")
-    for i, item in enumerate(items):
-        for user, message in item.items():
-            await inter.edit_original_response(
-                f"downloading videos... {i+1}/{len(items)}"
+    async with (
+        ProgressReporter(inter) as reporter,
+        scheduler.job("bake", PRIORITY_BAKE, reporter),
+    ):
+        reporter.update("extracting messages...")
+        data: dict[str, list[dict[str, str]]] = {channel: [] for channel in CHANNELS}
+        # per channel, in message order; downloads start as messages arrive
+        entries: list[list[tuple[str, str, asyncio.Task]]] = [[] for _ in CHANNELS]
+        found = 0
+        try:
+            async for index, user, message in collect_messages(hours):
+                data[CHANNELS[index]].append({user: message})
+                page_url = extract_url_with_prefix(message, "https://outplayed.tv/")
+                if not page_url:
+                    continue
+                task = asyncio.create_task(downloader.try_acquire(page_url))
+                entries[index].append((user, message, task))
+                found += 1
+                reporter.update(f"extracting messages... {found} clips found")
+            await asyncio.to_thread(
+                _dump_json,
+                data,
+                os.path.join(OUTPUT_TEXT_PATH, f"{output_fn}.json"),
+                indent=4,
             )
-            page_url = extract_url_with_prefix(message, "https://outplayed.tv/")
-            if not page_url:
+            download_tasks = [task for channel in entries for _, _, task in channel]
+            reporter.stage("downloading videos", len(download_tasks))
+            for future in asyncio.as_completed(download_tasks):
+                await future
+                reporter.advance()
+        finally:
+            for channel in entries:
+                for _, _, task in channel:
+                    task.cancel()
+        texts = []
+        fns = []
+        for user, message, task in (entry for channel in entries for entry in channel):
+            fn = task.result()
+            if not fn:
                 continue
-            fn = hashlib.md5(page_url.encode()).hexdigest() + ".mp4"
-            if not os.path.exists(os.path.join(VIDEO_PATH, fn)):
-                video_url = await extract_video_url(page_url)
-                if not video_url:
-                    continue
-                await download_video(video_url, os.path.join(VIDEO_PATH, fn))
             video_duration = await asyncio.to_thread(
                 get_media_duration, os.path.join(VIDEO_PATH, fn)
             )
@@ -352,7 +658,9 @@ async def bake(
             simple_msg = cleanup_msg(message)
             texts.append("@" + user + "\n" + simple_msg)
             fns.append(fn)
-    await create_and_upload_final_video(inter, texts, fns, output_fn, title)
+        await create_and_upload_final_video(
+            inter, texts, fns, output_fn, title, reporter
+        )
 
 
 class CustomizeModal(disnake.ui.Modal):
@@ -391,46 +699,50 @@ class CustomizeModal(disnake.ui.Modal):
         current_datetime = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
         output_fn = title + "-" + current_datetime
         await inter.response.defer()
-        await inter.edit_original_response("extracting messages...")
-        messages = [
-            line
-            for line in content.splitlines()
-            if extract_url_with_prefix(line, "https://outplayed.tv/")
-        ]
-        user = inter.user.display_name if user == "" else user
-        texts = []
-        fns = []
-        await inter.edit_original_response(f"downloading {len(messages)} videos...")
-        for i, message in enumerate(messages):
-            await inter.edit_original_response(
-                f"downloading videos... {i+1}/{len(messages)}"
-            )
-            page_url = extract_url_with_prefix(message, "https://outplayed.tv/")
-            if not page_url:
-                continue
-            fn = hashlib.md5(page_url.encode()).hexdigest() + ".mp4"
-            if not os.path.exists(os.path.join(VIDEO_PATH, fn)):
-                video_url = await extract_video_url(page_url)
-                if not video_url:
+        async with (
+            ProgressReporter(inter) as reporter,
+            scheduler.job("customize", PRIORITY_CUSTOMIZE, reporter),
+        ):
+            reporter.update("extracting messages...")
+            messages = [
+                line
+                for line in content.splitlines()
+                if extract_url_with_prefix(line, "https://outplayed.tv/")
+            ]
+            user = inter.user.display_name if user == "" else user
+            texts = []
+            fns = []
+            reporter.stage("downloading videos", len(messages))
+            page_urls = [
+                extract_url_with_prefix(message, "https://outplayed.tv/")
+                for message in messages
+            ]
+            downloaded: list[str | None] = [None] * len(messages)
+            async for i, fn in downloader.acquire_many(page_urls):
+                downloaded[i] = fn
+                reporter.advance()
+            for message, fn in zip(messages, downloaded):
+                if not fn:
                     continue
-                await download_video(video_url, os.path.join(VIDEO_PATH, fn))
-            video_duration = await asyncio.to_thread(
-                get_media_duration, os.path.join(VIDEO_PATH, fn)
-            )
-            if video_duration == 0.0:
-                logger.warning(
-                    f"video duration is 0: {os.path.join(VIDEO_PATH, fn)}, message {message}"
+                video_duration = await asyncio.to_thread(
+                    get_media_duration, os.path.join(VIDEO_PATH, fn)
                 )
-                continue
-            parts = message.rsplit("@", 1)
-            if len(parts) > 1:
-                simple_msg = cleanup_msg(parts[0])
-                user = parts[1].strip().lstrip("@") if parts[1].strip() else user
-            else:
-                simple_msg = cleanup_msg(message)
-            texts.append("@" + user + "\n" + simple_msg)
-            fns.append(fn)
-        await create_and_upload_final_video(inter, texts, fns, output_fn, title, True)
+                if video_duration == 0.0:
+                    logger.warning(
+                        f"video duration is 0: {os.path.join(VIDEO_PATH, fn)}, message {message}"
+                    )
+                    continue
+                parts = message.rsplit("@", 1)
+                if len(parts) > 1:
+                    simple_msg = cleanup_msg(parts[0])
+                    user = parts[1].strip().lstrip("@") if parts[1].strip() else user
+                else:
+                    simple_msg = cleanup_msg(message)
+                texts.append("@" + user + "\n" + simple_msg)
+                fns.append(fn)
+            await create_and_upload_final_video(
+                inter, texts, fns, output_fn, title, reporter
+            )
 
 
 @bot.slash_command(description="Bake a video from customized messages, 1 per line.")
@@ -11,6 +11,8 @@ OUTPUT_VIDEO_PATH = config.get("OUTPUT_VIDEO_PATH") or ""
 OUTPUT_IMAGE_PATH = config.get("OUTPUT_IMAGE_PATH") or ""
 OUTPUT_AUDIO_PATH = config.get("OUTPUT_AUDIO_PATH") or ""
 OUTPUT_TEXT_PATH = config.get("OUTPUT_TEXT_PATH") or ""
+CACHE_PATH = config.get("CACHE_PATH") or "./output/cache"
+TRACE_PATH = config.get("TRACE_PATH") or "./output/trace"
 FONT_FILE_PATH = config.get("FONT_FILE_PATH") or ""
 FONT_NAME = config.get("FONT_NAME") or ""
 RUN_GUILD = int(config.get("RUN_GUILD") or 0)
@@ -18,6 +20,48 @@ TEST_GUILD = int(config.get("TEST_GUILD") or 0)
 CATEGORY = config.get("CATEGORY") or ""
 CHANNELS = (config.get("CHANNELS") or "").split(",")
 DENY_EMOJIS = (config.get("DENY_EMOJIS") or "").split(",")
+RESOLVE_CONCURRENCY = int(config.get("RESOLVE_CONCURRENCY") or 8)
+DOWNLOAD_CONCURRENCY = int(config.get("DOWNLOAD_CONCURRENCY") or 4)
+DOWNLOAD_PER_HOST = int(config.get("DOWNLOAD_PER_HOST") or 8)
+RESOLVE_TTL_HOURS = float(config.get("RESOLVE_TTL_HOURS") or 24)
+RESOLVE_NEGATIVE_TTL_HOURS = float(config.get("RESOLVE_NEGATIVE_TTL_HOURS") or 6)
+CACHE_FLUSH_SECONDS = float(config.get("CACHE_FLUSH_SECONDS") or 30)
+CLIP_RETRY_HOURS = float(config.get("CLIP_RETRY_HOURS") or 24)
+DOWNLOAD_RETRIES = int(config.get("DOWNLOAD_RETRIES") or 3)
+DOWNLOAD_VERIFY = (config.get("DOWNLOAD_VERIFY") or "true").lower() == "true"
+ARCHIVE_SYNC_HOURS = float(config.get("ARCHIVE_SYNC_HOURS") or 6)
+# messages written to the archive per transaction while syncing
+ARCHIVE_BATCH_SIZE = int(config.get("ARCHIVE_BATCH_SIZE") or 1000)
+MAX_CONCURRENT_JOBS = int(config.get("MAX_CONCURRENT_JOBS") or 2)
+UPLOAD_CONCURRENCY = int(config.get("UPLOAD_CONCURRENCY") or 1)
+# must be a multiple of 256 KiB, every chunk is a resume point
+YOUTUBE_CHUNK_SIZE = int(config.get("YOUTUBE_CHUNK_MB") or 32) * 1024 * 1024
+PROGRESS_INTERVAL = float(config.get("PROGRESS_INTERVAL") or 2)
+# "auto" picks the fastest usable one of "nvenc", "qsv", "vaapi" and "software"
+ENCODER_BACKEND = config.get("ENCODER_BACKEND") or "auto"
+VAAPI_DEVICE = config.get("VAAPI_DEVICE") or "/dev/dri/renderD128"
+# "copy": clips are encoded once in the final codec and stream-copied on merge
+# "reencode": clips are re-encoded to the final codec on merge
+MERGE_MODE = config.get("MERGE_MODE") or "copy"
+# "segments": clips are encoded separately, then merged (see MERGE_MODE)
+# "graph": the whole compilation is rendered by one ffmpeg filter graph
+RENDER_MODE = config.get("RENDER_MODE") or "segments"
+# compilations with more clips than this are always rendered as segments
+RENDER_GRAPH_MAX_CLIPS = int(config.get("RENDER_GRAPH_MAX_CLIPS") or 64)
+# seconds before an ffmpeg run is killed, in total and without any output
+FFMPEG_TIMEOUT = float(config.get("FFMPEG_TIMEOUT") or 3 * 3600)
+FFMPEG_STALL_TIMEOUT = float(config.get("FFMPEG_STALL_TIMEOUT") or 300)
+# consumer NVIDIA GPUs cap concurrent NVENC sessions, so stay low by default
+ENCODE_WORKERS = int(config.get("ENCODE_WORKERS") or 0) or min(os.cpu_count() or 1, 4)
+# localhost port of the metrics endpoint, 0 disables it
+METRICS_PORT = int(config.get("METRICS_PORT") or 0)
+TRACE_KEEP = int(config.get("TRACE_KEEP") or 200)
+# byte budgets in GiB of the cached artifact directories, 0 for unlimited
+STORAGE_CLIPS_GB = float(config.get("STORAGE_CLIPS_GB") or 0)
+STORAGE_PROCESSED_GB = float(config.get("STORAGE_PROCESSED_GB") or 0)
+STORAGE_AUDIO_GB = float(config.get("STORAGE_AUDIO_GB") or 0)
+STORAGE_IMAGES_GB = float(config.get("STORAGE_IMAGES_GB") or 0)
+STORAGE_SWEEP_MINUTES = float(config.get("STORAGE_SWEEP_MINUTES") or 10)
 
 if not os.path.exists(VIDEO_PATH):
     os.makedirs(VIDEO_PATH)
@@ -35,3 +79,7 @@ if not os.path.exists(os.path.join(OUTPUT_AUDIO_PATH, "tmp")):
     os.makedirs(os.path.join(OUTPUT_AUDIO_PATH, "tmp"))
 if not os.path.exists(OUTPUT_TEXT_PATH):
     os.makedirs(OUTPUT_TEXT_PATH)
+if not os.path.exists(CACHE_PATH):
+    os.makedirs(CACHE_PATH)
+if not os.path.exists(TRACE_PATH):
+    os.makedirs(TRACE_PATH)
@@ -0,0 +1,199 @@
+import asyncio
+import datetime
+import functools
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from config import *
+from logger import logger
+from storage import storage
+from tracing import traced
+from utils import get_media_duration, run_async
+
+COVER_WIDTH = 1920
+COVER_HEIGHT = 1080
+# candidates are scored on thumbnails, only the winner is grabbed in full size
+THUMB_WIDTH = 320
+THUMB_HEIGHT = 180
+COVER_MAX_CLIPS = 6
+# relative positions inside each clip, skipping loading frames at the start
+COVER_POSITIONS = (0.25, 0.5, 0.75)
+# sharpness, contrast, colorfulness
+COVER_WEIGHTS = np.array([0.4, 0.3, 0.3], dtype=np.float32)
+GRAB_CONCURRENCY = 8
+
+
+@functools.cache
+def _font(size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(FONT_FILE_PATH, size)
+
+
+async def grab_frame(
+    video_path: str, seconds: float, width: int, height: int
+) -> np.ndarray | None:
+    """
+    Decode the single frame at `seconds` as an RGB array. `-ss` before `-i`
+    seeks on keyframes, so only a few frames are decoded.
+    """
+    args = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-ss",
+        f"{seconds:.3f}",
+        "-i",
+        video_path,
+        "-frames:v",
+        "1",
+        "-vf",
+        f"scale={width}:{height}",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "rgb24",
+        "-",
+    ]
+    result = await run_async(args, timeout=30, capture_stdout=True)
+    if result.returncode != 0 or len(result.stdout) != width * height * 3:
+        logger.warning(f"no frame at {seconds:.1f}s in {video_path}")
+        return None
+    return np.frombuffer(result.stdout, dtype=np.uint8).reshape(height, width, 3)
+
+
+def score_frames(frames: np.ndarray) -> np.ndarray:
+    """
+    Score a (N, H, W, 3) batch of RGB frames by sharpness (Laplacian
+    variance), contrast (luma deviation) and colorfulness (Hasler and
+    Suesstrunk), each relative to the best candidate of the batch.
+    """
+    rgb = frames.astype(np.float32)
+    gray = rgb @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    laplacian = (
+        gray[:, :-2, 1:-1]
+        + gray[:, 2:, 1:-1]
+        + gray[:, 1:-1, :-2]
+        + gray[:, 1:-1, 2:]
+        - 4 * gray[:, 1:-1, 1:-1]
+    )
+    sharpness = np.log1p(laplacian.var(axis=(1, 2)))
+    contrast = gray.std(axis=(1, 2))
+    rg = rgb[..., 0] - rgb[..., 1]
+    yb = 0.5 * (rgb[..., 0] + rgb[..., 1]) - rgb[..., 2]
+    colorfulness = np.hypot(rg.std(axis=(1, 2)), yb.std(axis=(1, 2))) + 0.3 * np.hypot(
+        rg.mean(axis=(1, 2)), yb.mean(axis=(1, 2))
+    )
+    metrics = np.stack([sharpness, contrast, colorfulness])
+    metrics /= np.maximum(metrics.max(axis=1, keepdims=True), 1e-6)
+    return COVER_WEIGHTS @ metrics
+
+
+def _candidate_clips(video_paths: list[str]) -> list[str]:
+    unique = list(dict.fromkeys(video_paths))
+    if len(unique) <= COVER_MAX_CLIPS:
+        return unique
+    step = len(unique) / COVER_MAX_CLIPS
+    return [unique[int(i * step)] for i in range(COVER_MAX_CLIPS)]
+
+
+async def pick_cover_frame(video_paths: list[str]) -> Image.Image:
+    """Return the best looking frame over a few positions in the given clips."""
+    slots = asyncio.Semaphore(GRAB_CONCURRENCY)
+
+    async def candidates(video_path: str) -> list[tuple[str, float, np.ndarray]]:
+        duration = await asyncio.to_thread(get_media_duration, video_path)
+        found = []
+        for position in COVER_POSITIONS:
+            async with slots:
+                frame = await grab_frame(
+                    video_path, duration * position, THUMB_WIDTH, THUMB_HEIGHT
+                )
+            if frame is not None:
+                found.append((video_path, duration * position, frame))
+        return found
+
+    results = await asyncio.gather(
+        *(candidates(path) for path in _candidate_clips(video_paths))
+    )
+    found = [candidate for result in results for candidate in result]
+    video_path, seconds = video_paths[0], 0.0
+    if found:
+        scores = score_frames(np.stack([frame for _, _, frame in found]))
+        best = int(scores.argmax())
+        video_path, seconds, _ = found[best]
+        logger.info(
+            f"cover frame {video_path} at {seconds:.1f}s, "
+            f"score {scores[best]:.2f} of {len(found)} candidates"
+        )
+    frame = await grab_frame(video_path, seconds, COVER_WIDTH, COVER_HEIGHT)
+    if frame is None:
+        raise RuntimeError(f"Error grabbing cover frame from {video_path}")
+    return Image.fromarray(frame)
+
+
+def render_cover(img: Image.Image, output_image_path: str) -> str:
+    draw = ImageDraw.Draw(img)
+
+    text1 = "Apex"
+    text2 = "精彩时刻"
+    text3 = datetime.datetime.now().strftime("%m/%d/%y")
+    color1 = (255, 223, 0)
+    color2 = (255, 69, 0)
+    color3 = (0, 150, 0)
+    font1 = _font(350)
+    font2 = _font(200)
+    font3 = _font(150)
+    img_width, img_height = img.size
+
+    text1_bbox = draw.textbbox((0, 0), text1, font=font1)
+    text1_width = text1_bbox[2] - text1_bbox[0]
+    text1_height = text1_bbox[3] - text1_bbox[1]
+    text1_x = (img_width - text1_width) / 2
+    text1_y = img_height * 0.0
+
+    text2_bbox = draw.textbbox((0, 0), text2, font=font2)
+    text2_width = text2_bbox[2] - text2_bbox[0]
+    text2_height = text2_bbox[3] - text2_bbox[1]
+    text2_x = (img_width - text2_width) / 2
+    text2_y = text1_y + text1_height + 100
+
+    text3_bbox = draw.textbbox((0, 0), text3, font=font3)
+    text3_width = text3_bbox[2] - text3_bbox[0]
+    text3_x = (img_width - text3_width) / 2
+    text3_y = text2_y + text2_height + 100
+
+    draw.text(
+        (text1_x, text1_y),
+        text1,
+        fill=color1,
+        font=font1,
+        stroke_width=20,
+        stroke_fill=(0, 0, 0),
+    )
+    draw.text(
+        (text2_x, text2_y),
+        text2,
+        fill=color2,
+        font=font2,
+        stroke_width=20,
+        stroke_fill=(0, 0, 0),
+    )
+    draw.text(
+        (text3_x, text3_y),
+        text3,
+        fill=color3,
+        font=font3,
+        stroke_width=10,
+        stroke_fill=(0, 0, 0),
+    )
+    img.save(output_image_path, format="JPEG", quality=90, optimize=True)
+    return output_image_path
+
+
+@traced("create_cover_image")
+async def create_cover_image(video_paths: list[str], output_image_path: str) -> str:
+    img = await pick_cover_frame(video_paths)
+    await asyncio.to_thread(render_cover, img, output_image_path)
+    storage.use(output_image_path)
+    return output_image_path
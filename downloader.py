@@ -0,0 +1,162 @@
+import asyncio
+import os
+from typing import AsyncIterator
+
+import aiohttp
+
+from config import *
+from logger import logger
+from scheduler import InFlight
+from storage import storage
+from utils import (
+    clip_filename,
+    download_video,
+    extract_video_url,
+    resolution_cache,
+)
+
+
+class ClipDownloader:
+    """
+    Resolves outplayed.tv pages and downloads their clips into VIDEO_PATH.
+
+    A single aiohttp session is shared by every request, so connections are
+    kept alive and pooled across clips and commands. Page resolution and file
+    transfer are bounded separately, and the connector caps connections per
+    host.
+    """
+
+    def __init__(
+        self,
+        resolve_concurrency: int = RESOLVE_CONCURRENCY,
+        download_concurrency: int = DOWNLOAD_CONCURRENCY,
+        per_host: int = DOWNLOAD_PER_HOST,
+    ):
+        self.resolve_concurrency = resolve_concurrency
+        self.download_concurrency = download_concurrency
+        self.per_host = per_host
+        self._session: aiohttp.ClientSession | None = None
+        self._resolve_sem: asyncio.Semaphore | None = None
+        self._download_sem: asyncio.Semaphore | None = None
+        self._inflight = InFlight("download")
+
+    def _ensure_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.resolve_concurrency + self.download_concurrency,
+                limit_per_host=self.per_host,
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._resolve_sem = asyncio.Semaphore(self.resolve_concurrency)
+            self._download_sem = asyncio.Semaphore(self.download_concurrency)
+        return self._session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def acquire(self, page_url: str) -> str | None:
+        """Return the clip filename in VIDEO_PATH, downloading it if needed."""
+        fn = clip_filename(page_url)
+        path = os.path.join(VIDEO_PATH, fn)
+        if os.path.exists(path):
+            storage.use(path, hit=True)
+            return fn
+        downloaded = await self._inflight.run(fn, lambda: self._download(page_url, fn))
+        if downloaded is not None:
+            storage.use(path, hit=False)
+        return downloaded
+
+    async def try_acquire(self, page_url: str) -> str | None:
+        """Like `acquire`, but logs errors and returns None instead of raising."""
+        try:
+            return await self.acquire(page_url)
+        except Exception as e:
+            logger.error(f"Error acquiring clip {page_url}: {e}")
+            return None
+
+    async def _download(self, page_url: str, fn: str) -> str | None:
+        output_path = os.path.join(VIDEO_PATH, fn)
+        session = self._ensure_session()
+        assert self._resolve_sem is not None and self._download_sem is not None
+        async with self._resolve_sem:
+            video_url = await extract_video_url(page_url, session)
+        if not video_url:
+            return None
+        async with self._download_sem:
+            ok = await download_video(video_url, output_path, session)
+        if not ok:
+            # the media url may have expired, resolve the page again next time
+            resolution_cache.invalidate(page_url)
+            return None
+        return fn
+
+    async def acquire_many(
+        self, page_urls: list[str]
+    ) -> AsyncIterator[tuple[int, str | None]]:
+        """Yield (index, filename) for each page url as soon as it finishes."""
+
+        async def worker(i: int, page_url: str) -> tuple[int, str | None]:
+            return i, await self.try_acquire(page_url)
+
+        tasks = [
+            asyncio.create_task(worker(i, page_url))
+            for i, page_url in enumerate(page_urls)
+        ]
+        try:
+            for future in asyncio.as_completed(tasks):
+                yield await future
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def acquire_ordered(
+        self, items, key=lambda item: item, lookahead: int | None = None
+    ) -> AsyncIterator[tuple[object, str | None]]:
+        """
+        Yield (item, filename) in the order of the async iterable `items`,
+        where `key(item)` is the page url, while prefetching up to
+        `lookahead` clips ahead, so callers that stop early do not download
+        the whole list. Items whose key is None are passed through with
+        filename None without acquiring anything.
+        """
+        if lookahead is None:
+            lookahead = self.resolve_concurrency
+        pending: list[tuple[object, asyncio.Task | None]] = []
+        items = aiter(items)
+        exhausted = False
+        try:
+            while True:
+                while not exhausted and len(pending) < lookahead:
+                    try:
+                        item = await anext(items)
+                    except StopAsyncIteration:
+                        exhausted = True
+                        break
+                    page_url = key(item)
+                    task = None
+                    if page_url is not None:
+                        task = asyncio.create_task(self.acquire(page_url))
+                    pending.append((item, task))
+                if not pending:
+                    return
+                item, task = pending.pop(0)
+                if task is None:
+                    yield item, None
+                    continue
+                try:
+                    fn = await task
+                except Exception as e:
+                    logger.error(f"Error acquiring clip {key(item)}: {e}")
+                    fn = None
+                yield item, fn
+        finally:
+            for _, task in pending:
+                if task is not None:
+                    task.cancel()
+
+
+downloader = ClipDownloader()
@@ -0,0 +1,144 @@
+import abc
+import functools
+import subprocess
+
+from config import *
+from logger import logger
+
+
+class EncoderBackend(abc.ABC):
+    """Maps codec, quality (CRF-like, 0-51) and speed onto ffmpeg flags."""
+
+    name = ""
+    hwaccel = ""
+    encoders: dict[str, str] = {}
+    pix_fmt = "yuv420p"
+    filter_suffix = ""
+
+    def device_args(self) -> list[str]:
+        """Global options, given once per ffmpeg run."""
+        return []
+
+    def decode_args(self) -> list[str]:
+        """Per-input options, given before every `-i`."""
+        return ["-hwaccel", self.hwaccel] if self.hwaccel else []
+
+    def input_args(self) -> list[str]:
+        return [*self.device_args(), *self.decode_args()]
+
+    def supports(self, codec: str) -> bool:
+        return codec in self.encoders
+
+    @abc.abstractmethod
+    def quality_args(self, codec: str, quality: int, speed: str) -> list[str]:
+        """Rate control flags for `quality` at the given speed preset."""
+
+    def video_args(self, codec: str, quality: int, speed: str = "medium") -> list[str]:
+        args = ["-c:v", self.encoders[codec]]
+        args += self.quality_args(codec, quality, speed)
+        if self.pix_fmt:
+            args += ["-pix_fmt", self.pix_fmt]
+        return args
+
+
+class NvencBackend(EncoderBackend):
+    name = "nvenc"
+    hwaccel = "cuda"
+    encoders = {"h264": "h264_nvenc", "hevc": "hevc_nvenc", "av1": "av1_nvenc"}
+
+    def quality_args(self, codec, quality, speed):
+        preset = {"fast": "p2", "medium": "p4", "slow": "p6"}[speed]
+        return ["-preset", preset, "-rc", "vbr", "-cq", str(quality), "-b:v", "0"]
+
+
+class QsvBackend(EncoderBackend):
+    name = "qsv"
+    hwaccel = "qsv"
+    encoders = {"h264": "h264_qsv", "hevc": "hevc_qsv", "av1": "av1_qsv"}
+    pix_fmt = "nv12"
+
+    def quality_args(self, codec, quality, speed):
+        return ["-preset", speed, "-global_quality", str(quality)]
+
+
+class VaapiBackend(EncoderBackend):
+    name = "vaapi"
+    hwaccel = "vaapi"
+    encoders = {"h264": "h264_vaapi", "hevc": "hevc_vaapi", "av1": "av1_vaapi"}
+    pix_fmt = ""
+    filter_suffix = ",format=nv12,hwupload"
+
+    def device_args(self):
+        return ["-vaapi_device", VAAPI_DEVICE]
+
+    def quality_args(self, codec, quality, speed):
+        return ["-rc_mode", "CQP", "-qp", str(quality)]
+
+
+class SoftwareBackend(EncoderBackend):
+    name = "software"
+    encoders = {"h264": "libx264", "hevc": "libx265", "av1": "libsvtav1"}
+
+    def quality_args(self, codec, quality, speed):
+        if codec == "av1":
+            preset = {"fast": "10", "medium": "8", "slow": "6"}[speed]
+            return ["-preset", preset, "-crf", str(quality)]
+        preset = {"fast": "veryfast", "medium": "fast", "slow": "medium"}[speed]
+        return ["-preset", preset, "-crf", str(quality)]
+
+
+# fastest first
+BACKENDS = [NvencBackend(), QsvBackend(), VaapiBackend(), SoftwareBackend()]
+
+
+def _ffmpeg_list(option: str) -> str:
+    try:
+        result = subprocess.run(
+            ["ffmpeg", "-hide_banner", option], capture_output=True, text=True
+        )
+        return result.stdout or ""
+    except FileNotFoundError:
+        logger.error("ffmpeg not found in PATH")
+        return ""
+
+
+def _can_encode(backend: EncoderBackend, codec: str) -> bool:
+    """Encode a few blank frames, as a listed encoder may lack the hardware."""
+    args = [
+        "ffmpeg",
+        "-hide_banner",
+        *backend.input_args(),
+        "-f",
+        "lavfi",
+        "-i",
+        "color=size=256x256:rate=30:duration=0.2",
+        "-vf",
+        "null" + backend.filter_suffix,
+        *backend.video_args(codec, 28),
+        "-f",
+        "null",
+        "-",
+    ]
+    return subprocess.run(args, capture_output=True, text=True).returncode == 0
+
+
+@functools.cache
+def get_encoder_backend(codec: str = "hevc") -> EncoderBackend:
+    """Pick the fastest backend that can encode `codec` on this machine."""
+    encoders = _ffmpeg_list("-encoders")
+    hwaccels = _ffmpeg_list("-hwaccels").split()
+    candidates = [
+        backend
+        for backend in BACKENDS
+        if ENCODER_BACKEND in ("auto", backend.name)
+        and backend.supports(codec)
+        and f" {backend.encoders[codec]} " in encoders
+        and (not backend.hwaccel or backend.hwaccel in hwaccels)
+    ]
+    for backend in candidates:
+        if _can_encode(backend, codec):
+            logger.info(f"Using {backend.name} encoder backend for {codec}")
+            return backend
+        logger.warning(f"{backend.name} encoder backend unusable for {codec}")
+    logger.error(f"No usable encoder backend for {codec}, falling back to software")
+    return SoftwareBackend()
@@ -0,0 +1,112 @@
+import asyncio
+import time
+
+import disnake
+
+from config import *
+from logger import logger
+
+
+def format_seconds(seconds: float) -> str:
+    hours = int(seconds // 3600)
+    minutes = int((seconds % 3600) // 60)
+    secs = int(seconds % 60)
+    if hours == 0:
+        if minutes == 0:
+            return f"{secs:02d}s"
+        return f"{minutes:02d}:{secs:02d}"
+    return f"{hours:02d}:{minutes:02d}:{secs:02d}"
+
+
+class ProgressReporter:
+    """
+    Shows job progress in the interaction response without slowing the job.
+
+    `update` and `advance` only record the latest state; a background task
+    sends it at most every `interval` seconds, so intermediate states are
+    coalesced and Discord rate limits or retries never block the pipeline.
+    Once the interaction token expires, a channel message takes its place.
+    """
+
+    def __init__(
+        self,
+        inter: disnake.Interaction,
+        interval: float = PROGRESS_INTERVAL,
+    ):
+        self.inter = inter
+        self.interval = interval
+        self._content = ""
+        self._sent = ""
+        self._dirty = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._message: disnake.Message | None = None
+        self._stage = ""
+        self._total = 0
+        self._done = 0
+        self._started = 0.0
+
+    async def __aenter__(self) -> "ProgressReporter":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.close()
+
+    def update(self, content: str) -> None:
+        self._content = content
+        self._dirty.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stage(self, name: str, total: int) -> None:
+        """Start a counted stage, used by `advance` for throughput and ETA."""
+        self._stage = name
+        self._total = total
+        self._done = 0
+        self._started = time.monotonic()
+        self.update(f"{name} {total}...")
+
+    def advance(self, n: int = 1) -> None:
+        self._done += n
+        content = f"{self._stage}... {self._done}/{self._total}"
+        elapsed = time.monotonic() - self._started
+        if elapsed > 0 and self._done < self._total:
+            rate = self._done / elapsed
+            eta = (self._total - self._done) / rate
+            content += f" ({rate:.2f}/s, ETA {format_seconds(eta)})"
+        self.update(content)
+
+    async def send_now(self, content: str) -> None:
+        """Send immediately, for final results that must not be coalesced."""
+        self._content = content
+        self._dirty.clear()
+        await self._send()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        if self._content != self._sent:
+            await self._send()
+
+    async def _run(self) -> None:
+        while True:
+            await self._dirty.wait()
+            self._dirty.clear()
+            await self._send()
+            await asyncio.sleep(self.interval)
+
+    async def _send(self) -> None:
+        async with self._lock:
+            content = self._content
+            if content == self._sent:
+                return
+            try:
+                if self._message is None and not self.inter.is_expired():
+                    await self.inter.edit_original_response(content)
+                elif self._message is None:
+                    self._message = await self.inter.channel.send(content)
+                else:
+                    await self._message.edit(content=content)
+                self._sent = content
+            except Exception as e:
+                logger.error(f"Error reporting progress: {e}")
@@ -0,0 +1,122 @@
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+
+from config import *
+from logger import logger
+from storage import storage
+from tracing import metrics, span, trace_job
+
+PRIORITY_CUSTOMIZE = 0
+PRIORITY_BAKE = 1
+PRIORITY_EXCAVATE = 2
+
+
+class InFlight:
+    """
+    Runs each keyed piece of work once at a time. Callers asking for a key
+    that is already running await the same result instead of redoing it.
+    The work is cancelled once every caller waiting for it is cancelled, and
+    a later caller only starts it over after the cancelled attempt is done.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._tasks: dict[str, asyncio.Task] = {}
+        self._waiters: collections.Counter[str] = collections.Counter()
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    async def run(self, key: str, factory):
+        task = self._tasks.get(key)
+        while task is not None and task.cancelling():
+            # start over only once the cancelled attempt has cleaned up its files
+            await asyncio.wait([task])
+            self._forget(key, task)
+            task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.create_task(factory())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._forget(key, task))
+        else:
+            logger.info(f"{self.name} {key} already in flight, waiting for it")
+        self._waiters[key] += 1
+        try:
+            # one caller giving up must not cancel the work for the others
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not task.done():
+                logger.info(f"{self.name} {key} has no waiters left, cancelling it")
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if self._waiters[key] <= 0:
+                del self._waiters[key]
+
+
+class JobScheduler:
+    """
+    Admits slash command jobs by priority (lower runs first) with at most
+    `max_jobs` running at once. Downloads, encodes and uploads are further
+    bounded globally across all jobs.
+    """
+
+    def __init__(self, max_jobs: int = MAX_CONCURRENT_JOBS):
+        self.max_jobs = max_jobs
+        self.uploads = {
+            platform: asyncio.Semaphore(UPLOAD_CONCURRENCY)
+            for platform in ("youtube", "bilibili")
+        }
+        self._running = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    @contextlib.asynccontextmanager
+    async def job(self, name: str, priority: int, reporter=None):
+        async with trace_job(name):
+            with storage.job():
+                with span("queued", priority=priority):
+                    await self._admit(name, priority, reporter)
+                logger.info(f"job {name} started")
+                metrics.gauge("jobs.running", self._running)
+                try:
+                    yield
+                finally:
+                    self._release()
+                    metrics.gauge("jobs.running", self._running)
+                    metrics.gauge("jobs.queued", len(self._waiters))
+                    logger.info(f"job {name} finished")
+
+    async def _admit(self, name: str, priority: int, reporter) -> None:
+        if self._running < self.max_jobs and not self._waiters:
+            self._running += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        metrics.gauge("jobs.queued", len(self._waiters))
+        logger.info(f"job {name} queued behind {self._running} running jobs")
+        if reporter is not None:
+            reporter.update(f"queued behind {self._running} running jobs...")
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+
+    def _release(self) -> None:
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                # hand the slot over directly, the running count is unchanged
+                future.set_result(None)
+                return
+        self._running -= 1
+
+
+scheduler = JobScheduler()
@@ -0,0 +1,166 @@
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+
+from config import *
+from logger import logger
+from tracing import metrics
+
+GiB = 1024**3
+
+
+class StorageManager:
+    """
+    Keeps cached artifacts within a byte budget per directory.
+
+    `use` records every lookup of an artifact as a hit or a miss and its last
+    access time, and pins it for the rest of the current job. `sweep` deletes
+    the least recently used unpinned files of every area over its budget.
+    Access times are tracked here, as filesystems are often mounted noatime.
+    """
+
+    def __init__(self, areas: dict[str, tuple[str, int]], access_log_path: str):
+        # area name -> (directory, budget in bytes, 0 for unlimited)
+        self.areas = {
+            name: (os.path.abspath(path), budget)
+            for name, (path, budget) in areas.items()
+        }
+        self.access_log_path = access_log_path
+        self.last_access: dict[str, float] = {}
+        self.hits: collections.Counter[str] = collections.Counter()
+        self.misses: collections.Counter[str] = collections.Counter()
+        self._pins: collections.Counter[str] = collections.Counter()
+        self._job_pins: contextvars.ContextVar[set[str] | None] = (
+            contextvars.ContextVar("pins", default=None)
+        )
+        self._lock = threading.Lock()
+        if os.path.exists(access_log_path):
+            try:
+                with open(access_log_path, "r", encoding="utf-8") as f:
+                    self.last_access = json.load(f)
+            except Exception as e:
+                logger.error(f"Error loading storage access log: {e}")
+
+    def area_of(self, path: str) -> str | None:
+        directory = os.path.dirname(os.path.abspath(path))
+        for name, (area_path, _) in self.areas.items():
+            if directory == area_path:
+                return name
+        return None
+
+    def use(self, path: str, hit: bool | None = None) -> None:
+        """
+        Record an access to `path`. `hit` tells whether a cached artifact was
+        reused or had to be produced, None for outputs that are never reused.
+        """
+        path = os.path.abspath(path)
+        area = self.area_of(path)
+        if area is None:
+            return
+        with self._lock:
+            self.last_access[path] = time.time()
+            if hit is not None:
+                (self.hits if hit else self.misses)[area] += 1
+            pins = self._job_pins.get()
+            if pins is not None and path not in pins:
+                pins.add(path)
+                self._pins[path] += 1
+        if hit is not None:
+            metrics.count(f"storage.{area}.{'hit' if hit else 'miss'}")
+
+    @contextlib.contextmanager
+    def job(self):
+        """Pin everything used inside it until it exits."""
+        pins: set[str] = set()
+        token = self._job_pins.set(pins)
+        try:
+            yield
+        finally:
+            self._job_pins.reset(token)
+            with self._lock:
+                for path in pins:
+                    self._pins[path] -= 1
+                    if self._pins[path] <= 0:
+                        del self._pins[path]
+
+    def hit_rate(self, area: str) -> float | None:
+        total = self.hits[area] + self.misses[area]
+        return self.hits[area] / total if total else None
+
+    def sweep(self) -> int:
+        """Evict cold files until every area fits its budget. Returns bytes freed."""
+        freed = 0
+        for name, (path, budget) in self.areas.items():
+            files = []
+            total = 0
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    # .part files are downloads or encodes in progress
+                    if not entry.is_file() or ".part" in entry.name:
+                        continue
+                    stat = entry.stat()
+                    total += stat.st_size
+                    files.append((entry.path, stat.st_size, stat.st_mtime))
+            with self._lock:
+                pinned = set(self._pins)
+                files.sort(key=lambda f: self.last_access.get(f[0], f[2]))
+            evicted = 0
+            for file_path, size, _ in files:
+                if not budget or total <= budget:
+                    break
+                if file_path in pinned:
+                    continue
+                try:
+                    os.remove(file_path)
+                except OSError as e:
+                    logger.error(f"Error evicting {file_path}: {e}")
+                    continue
+                total -= size
+                freed += size
+                evicted += 1
+                with self._lock:
+                    self.last_access.pop(file_path, None)
+            hit_rate = self.hit_rate(name)
+            metrics.gauge(f"storage.{name}.bytes", total)
+            metrics.count(f"storage.{name}.evicted", evicted)
+            if hit_rate is not None:
+                metrics.gauge(f"storage.{name}.hit_rate", hit_rate)
+            logger.info(
+                f"storage {name}: {total / GiB:.2f}"
+                + (f"/{budget / GiB:.2f}" if budget else "")
+                + f" GiB in {len(files) - evicted} files, {evicted} evicted"
+                + (f", hit rate {hit_rate:.0%}" if hit_rate is not None else "")
+            )
+        self.save()
+        return freed
+
+    def save(self) -> None:
+        with self._lock:
+            known = {
+                path: accessed
+                for path, accessed in self.last_access.items()
+                if os.path.exists(path)
+            }
+            self.last_access = known
+        tmp_path = self.access_log_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(known, f)
+        os.replace(tmp_path, self.access_log_path)
+
+
+storage = StorageManager(
+    {
+        "clips": (VIDEO_PATH, int(STORAGE_CLIPS_GB * GiB)),
+        "processed": (
+            os.path.join(OUTPUT_VIDEO_PATH, "tmp"),
+            int(STORAGE_PROCESSED_GB * GiB),
+        ),
+        "audio": (os.path.join(OUTPUT_AUDIO_PATH, "tmp"), int(STORAGE_AUDIO_GB * GiB)),
+        "images": (OUTPUT_IMAGE_PATH, int(STORAGE_IMAGES_GB * GiB)),
+    },
+    os.path.join(CACHE_PATH, "storage_access.json"),
+)
@@ -0,0 +1,128 @@
+import asyncio
+import bisect
+import datetime
+import json
+import os
+import time
+
+from config import *
+from logger import logger
+
+
+def timeline_key(channel: str, dt: datetime.datetime, page_url: str) -> str:
+    return f"{channel}|{dt.strftime('%Y-%m-%d %H:%M:%S')}|{page_url}"
+
+
+class TimelineIndex:
+    """
+    Persisted mapping from global timeline position to cumulative duration.
+
+    The index is rebuilt while walking the timeline: after `reset`, `advance`
+    adds the next clip if its duration is already known, so the cumulative
+    durations of the known prefix are available without touching any clip,
+    and `append` adds a newly probed one. A walk can stop as soon as it
+    covers the time it needs. `seek` binary-searches it for a time offset.
+    Clips that could not be downloaded or probed are stored as negative
+    entries with duration 0, which are retried once `failure_ttl` runs out.
+    """
+
+    def __init__(self, path: str, failure_ttl: float):
+        self.path = path
+        self.failure_ttl = failure_ttl
+        self.known: dict[str, float] = {}
+        # key -> time of the failed download or probe
+        self.failed: dict[str, float] = {}
+        self.keys: list[str] = []
+        self.durations: list[float] = []
+        self.cumulative: list[float] = []
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                for key, duration, _ in data["entries"]:
+                    if duration > 0:
+                        self.known[key] = duration
+                self.failed = data.get("failed", {})
+            except Exception as e:
+                logger.error(f"Error loading timeline index {path}: {e}")
+
+    def reset(self) -> None:
+        self.keys = []
+        self.durations = []
+        self.cumulative = []
+
+    @property
+    def indexed(self) -> int:
+        return len(self.cumulative)
+
+    @property
+    def total(self) -> float:
+        return self.cumulative[-1] if self.cumulative else 0.0
+
+    def duration_of(self, key: str) -> float | None:
+        """Known duration of `key`, 0 for a recent failure, None if unknown."""
+        duration = self.known.get(key)
+        if duration is not None:
+            return duration
+        failed_at = self.failed.get(key)
+        if failed_at is not None and time.time() - failed_at < self.failure_ttl:
+            return 0.0
+        return None
+
+    def advance(self, key: str) -> bool:
+        """Add `key` if its duration is known, returning whether it was."""
+        duration = self.duration_of(key)
+        if duration is None:
+            return False
+        self._push(key, duration)
+        return True
+
+    def append(self, key: str, duration: float) -> None:
+        if duration > 0:
+            self.known[key] = duration
+            self.failed.pop(key, None)
+        else:
+            self.failed[key] = time.time()
+        self._push(key, duration)
+
+    def _push(self, key: str, duration: float) -> None:
+        self.keys.append(key)
+        self.durations.append(duration)
+        self.cumulative.append(self.total + duration)
+
+    def seek(self, seconds: float) -> int:
+        """Return the first position whose cumulative duration reaches `seconds`."""
+        return bisect.bisect_left(self.cumulative, seconds)
+
+    def save(self) -> None:
+        entries = [
+            [key, duration, cumulative]
+            for key, duration, cumulative in zip(
+                self.keys, self.durations, self.cumulative
+            )
+            if duration > 0
+        ]
+        # keep durations of clips that are not part of the current prefix
+        indexed_keys = set(self.keys)
+        entries += [
+            [key, duration, None]
+            for key, duration in self.known.items()
+            if key not in indexed_keys
+        ]
+        now = time.time()
+        failed = {
+            key: failed_at
+            for key, failed_at in self.failed.items()
+            if now - failed_at < self.failure_ttl
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": entries, "failed": failed}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+timeline_index = TimelineIndex(
+    os.path.join(CACHE_PATH, "timeline_index.json"), CLIP_RETRY_HOURS * 3600
+)
+# concurrent excavate jobs must not rebuild and extend the shared index at once
+timeline_lock = asyncio.Lock()
@@ -0,0 +1,300 @@
+import asyncio
+import bisect
+import collections
+import contextvars
+import datetime
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+from aiohttp import web
+
+from config import *
+from logger import logger
+
+
+class Histogram:
+    """Fixed log-spaced buckets from 1ms up to about an hour."""
+
+    BOUNDS = [0.001 * 2**i for i in range(23)]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.BOUNDS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "mean": round(self.sum / self.count, 6) if self.count else 0.0,
+            "max": round(self.max, 6),
+            "p50": round(self.quantile(0.5), 6),
+            "p90": round(self.quantile(0.9), 6),
+            "p99": round(self.quantile(0.99), 6),
+        }
+
+
+class Metrics:
+    """Process-wide counters, gauges and histograms since startup."""
+
+    def __init__(self):
+        self.started = time.time()
+        self.counters: collections.Counter[str] = collections.Counter()
+        self.gauges: dict[str, float] = {}
+        self.histograms: collections.defaultdict[str, Histogram] = (
+            collections.defaultdict(Histogram)
+        )
+        self._lock = threading.Lock()
+
+    def count(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name: str, value: float) -> None:
+        self.gauges[name] = value
+
+    def observe(self, name: str, value: float) -> None:
+        with self._lock:
+            self.histograms[name].observe(value)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "uptime": round(time.time() - self.started, 3),
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "histograms": {
+                    name: histogram.snapshot()
+                    for name, histogram in sorted(self.histograms.items())
+                },
+            }
+
+
+metrics = Metrics()
+_trace: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar(
+    "trace", default=None
+)
+_span: contextvars.ContextVar["Span | None"] = contextvars.ContextVar(
+    "span", default=None
+)
+_trace_ids = itertools.count(1)
+
+
+class Span:
+    """
+    Times one stage of the current job. Attributes set on it end up in the
+    trace event, and every span also feeds a `span.<name>.seconds` histogram.
+    """
+
+    def __init__(self, name: str, args: dict):
+        self.name = name
+        self.args = args
+        self.trace: Trace | None = None
+        self.lane = 0
+        self.start = 0.0
+        self.duration = 0.0
+        self._token: contextvars.Token | None = None
+
+    def set(self, **args) -> None:
+        self.args.update(args)
+
+    def __enter__(self) -> "Span":
+        self.trace = _trace.get()
+        if self.trace is not None:
+            self.lane = self.trace.lane()
+        self.start = time.perf_counter()
+        self._token = _span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.duration = time.perf_counter() - self.start
+        _span.reset(self._token)
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        metrics.observe(f"span.{self.name}.seconds", self.duration)
+        if self.trace is not None:
+            self.trace.add(self)
+        return False
+
+
+def span(name: str, **args) -> Span:
+    return Span(name, args)
+
+
+def current_span() -> Span:
+    """The innermost open span, or a detached one if there is none."""
+    return _span.get() or Span("", {})
+
+
+def traced(name: str):
+    """Run the decorated function, sync or async, inside a span."""
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class Trace:
+    """Spans of one job, saved as Chrome trace JSON (chrome://tracing, Perfetto)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.id = f"{datetime.datetime.now():%Y%m%d-%H%M%S}-{name}-{next(_trace_ids)}"
+        self.origin = time.perf_counter()
+        self.events: list[dict] = []
+        self._lanes: dict[int, int] = {}
+
+    def lane(self) -> int:
+        """One timeline row per asyncio task or worker thread."""
+        try:
+            key = id(asyncio.current_task())
+        except RuntimeError:
+            key = threading.get_ident()
+        return self._lanes.setdefault(key, len(self._lanes) + 1)
+
+    def add(self, span: Span) -> None:
+        self.events.append(
+            {
+                "name": span.name,
+                "cat": self.name,
+                "ph": "X",
+                "ts": round((span.start - self.origin) * 1e6),
+                "dur": round(span.duration * 1e6),
+                "pid": 1,
+                "tid": span.lane,
+                "args": span.args,
+            }
+        )
+
+    def save(self) -> str:
+        path = os.path.join(TRACE_PATH, f"{self.id}.json")
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {"traceEvents": self.events, "displayTimeUnit": "ms"},
+                f,
+                ensure_ascii=False,
+                default=str,
+            )
+        fns = sorted(fn for fn in os.listdir(TRACE_PATH) if fn.endswith(".json"))
+        for fn in fns[: max(len(fns) - TRACE_KEEP, 0)]:
+            os.remove(os.path.join(TRACE_PATH, fn))
+        return path
+
+
+class trace_job:
+    """
+    Collect the spans of everything run inside it into one job trace, which
+    is saved in a worker thread when the job exits.
+    """
+
+    def __init__(self, name: str):
+        self.trace = Trace(name)
+        self._span = span(name)
+        self._token: contextvars.Token | None = None
+
+    async def __aenter__(self) -> Trace:
+        metrics.count(f"job.{self.trace.name}.started")
+        self._token = _trace.set(self.trace)
+        self._span.__enter__()
+        return self.trace
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        self._span.__exit__(exc_type, exc, tb)
+        _trace.reset(self._token)
+        outcome = "failed" if exc_type is not None else "finished"
+        metrics.count(f"job.{self.trace.name}.{outcome}")
+        try:
+            path = await asyncio.to_thread(self.trace.save)
+            logger.info(f"trace of job {self.trace.name} saved to {path}")
+        except Exception as e:
+            logger.error(f"Error saving trace {self.trace.id}: {e}")
+        return False
+
+
+async def monitor_event_loop(interval: float = 0.5) -> None:
+    """Record how late the loop wakes up, i.e. how long callbacks block it."""
+    loop = asyncio.get_running_loop()
+    while True:
+        scheduled = loop.time() + interval
+        await asyncio.sleep(interval)
+        lag = max(loop.time() - scheduled, 0.0)
+        metrics.observe("event_loop.lag_seconds", lag)
+        metrics.gauge("event_loop.lag_seconds", lag)
+        metrics.gauge("event_loop.tasks", len(asyncio.all_tasks(loop)))
+
+
+async def _metrics_handler(request: web.Request) -> web.Response:
+    return web.json_response(metrics.snapshot())
+
+
+async def _traces_handler(request: web.Request) -> web.Response:
+    fns = sorted(fn for fn in os.listdir(TRACE_PATH) if fn.endswith(".json"))
+    return web.json_response([fn.removesuffix(".json") for fn in reversed(fns)])
+
+
+async def _trace_handler(request: web.Request) -> web.FileResponse:
+    fn = os.path.basename(request.match_info["trace_id"]) + ".json"
+    path = os.path.join(TRACE_PATH, fn)
+    if not os.path.exists(path):
+        raise web.HTTPNotFound()
+    return web.FileResponse(path)
+
+
+_monitor_task: asyncio.Task | None = None
+
+
+async def start_monitoring() -> None:
+    """
+    Start the loop lag monitor and, unless METRICS_PORT is 0, serve
+    /metrics, /traces and /traces/<id> on localhost. Safe to call again.
+    """
+    global _monitor_task
+    if _monitor_task is not None:
+        return
+    _monitor_task = asyncio.create_task(monitor_event_loop())
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    app.router.add_get("/traces", _traces_handler)
+    app.router.add_get("/traces/{trace_id}", _trace_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", METRICS_PORT).start()
+    logger.info(f"serving metrics on http://127.0.0.1:{METRICS_PORT}/metrics")
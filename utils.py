@@ -1,19 +1,28 @@
-import datetime
-import io
+import asyncio
+import codecs
+import collections
+import hashlib
+import heapq
 import json
 import logging
+import math
 import os
 import random
 import re
 import shlex
 import subprocess
 import tempfile
+import threading
+import time
 from urllib.parse import urlparse
 
 import aiohttp
-from PIL import Image, ImageDraw, ImageFont
 
 from config import *
+from encoders import get_encoder_backend
+from scheduler import InFlight
+from storage import storage
+from tracing import current_span, metrics, span, traced
 
 
 def subprocess_run(*args, **kwargs):
@@ -85,27 +94,276 @@ def subprocess_run(*args, **kwargs):
     return result
 
 
-subprocess.run = subprocess_run
+def _parse_progress(block: dict[str, str]) -> dict:
+    def number(value: str | None, cast=float):
+        try:
+            return cast(str(value).rstrip("x"))
+        except ValueError:
+            return None
+
+    out_time_us = number(block.get("out_time_us"), int)
+    return {
+        "frame": number(block.get("frame"), int),
+        "fps": number(block.get("fps")),
+        "speed": number(block.get("speed")),
+        "out_time": out_time_us / 1e6 if out_time_us is not None else None,
+        "done": block.get("progress") == "end",
+    }
+
+
+async def _iter_lines(stream: asyncio.StreamReader):
+    """Split on both newlines and ffmpeg's carriage-return status updates."""
+    buffer = b""
+    while chunk := await stream.read(65536):
+        *lines, buffer = re.split(rb"[\r\n]", buffer + chunk)
+        for line in lines:
+            if line:
+                yield line
+    if buffer:
+        yield buffer
 
 
-async def extract_video_url(url):
+async def _kill(process: asyncio.subprocess.Process) -> None:
+    if process.returncode is not None:
+        return
+    process.terminate()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                response.raise_for_status()
-                html_content = await response.text()
-        video_src_pattern = re.search(
-            r'<video[^>]*src=[\'"]([^\'"]+)[\'"]', html_content
+        await asyncio.wait_for(process.wait(), 5)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+
+
+async def run_async(
+    args: list[str],
+    *,
+    timeout: float | None = None,
+    stall_timeout: float | None = None,
+    on_progress=None,
+    capture_stdout: bool = False,
+    check: bool = False,
+    max_log_lines: int = 200,
+) -> subprocess.CompletedProcess:
+    """
+    Run a command on the event loop instead of blocking a thread.
+
+    Only the last `max_log_lines` output lines are kept (as `stderr`), and
+    `stdout` is only collected with `capture_stdout`. For ffmpeg commands,
+    `on_progress` receives parsed `-progress` events (frame, fps, speed,
+    out_time). The child is killed if it runs longer than `timeout`, prints
+    nothing for `stall_timeout` seconds, or the calling task is cancelled.
+    """
+    if on_progress is not None:
+        args = [args[0], "-progress", "pipe:1", "-nostats", *args[1:]]
+    logging.info(f"Running command: {shlex.join(args)}")
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    log: collections.deque[str] = collections.deque(maxlen=max_log_lines)
+    stdout_chunks: list[bytes] = []
+    loop = asyncio.get_running_loop()
+    last_activity = loop.time()
+
+    async def read_stdout():
+        nonlocal last_activity
+        if capture_stdout:
+            while chunk := await process.stdout.read(65536):
+                last_activity = loop.time()
+                stdout_chunks.append(chunk)
+            return
+        block: dict[str, str] = {}
+        async for raw_line in _iter_lines(process.stdout):
+            last_activity = loop.time()
+            line = raw_line.decode("utf-8", errors="replace").rstrip()
+            if on_progress is None:
+                log.append(line)
+                continue
+            key, _, value = line.partition("=")
+            block[key.strip()] = value.strip()
+            if key == "progress":
+                on_progress(_parse_progress(block))
+                block = {}
+
+    async def read_stderr():
+        nonlocal last_activity
+        async for raw_line in _iter_lines(process.stderr):
+            last_activity = loop.time()
+            log.append(raw_line.decode("utf-8", errors="replace").rstrip())
+
+    async def communicate():
+        await asyncio.gather(read_stdout(), read_stderr())
+        return await process.wait()
+
+    task = asyncio.create_task(communicate())
+    deadline = loop.time() + timeout if timeout else None
+    try:
+        while not task.done():
+            await asyncio.wait({task}, timeout=1)
+            now = loop.time()
+            if deadline is not None and now > deadline:
+                raise subprocess.TimeoutExpired(args, timeout, stderr="\n".join(log))
+            if stall_timeout and now - last_activity > stall_timeout:
+                logging.error(f"No output for {stall_timeout}s: {shlex.join(args)}")
+                raise subprocess.TimeoutExpired(
+                    args, stall_timeout, stderr="\n".join(log)
+                )
+        returncode = task.result()
+    finally:
+        if not task.done():
+            task.cancel()
+            await _kill(process)
+    result = subprocess.CompletedProcess(
+        args=args,
+        returncode=returncode,
+        stdout=b"".join(stdout_chunks) if capture_stdout else None,
+        stderr="\n".join(log),
+    )
+    if check and returncode != 0:
+        logging.error(f"Command failed ({returncode}): {result.stderr}")
+        raise subprocess.CalledProcessError(
+            returncode, args, result.stdout, result.stderr
         )
-        if not video_src_pattern:
+    return result
+
+
+async def run_ffmpeg(args: list[str], on_progress=None) -> subprocess.CompletedProcess:
+    with span("ffmpeg", output=os.path.basename(args[-1])) as ffmpeg_span:
+
+        # progress events double as a heartbeat for the stall timeout
+        def on_event(event: dict) -> None:
+            ffmpeg_span.set(
+                out_time=event["out_time"], fps=event["fps"], speed=event["speed"]
+            )
+            if on_progress is not None:
+                on_progress(event)
+
+        return await run_async(
+            args,
+            timeout=FFMPEG_TIMEOUT or None,
+            stall_timeout=FFMPEG_STALL_TIMEOUT or None,
+            on_progress=on_event,
+            check=True,
+        )
+
+
+# limits concurrent encodes, the work itself runs in ffmpeg child processes
+encode_slots = asyncio.Semaphore(ENCODE_WORKERS)
+encode_inflight = InFlight("encode")
+
+
+def _write_atomic(path: str, data: str) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class ResolutionCache:
+    """
+    Persistent page url -> media url map. Pages without a video are stored
+    as negative entries (None) so they are not fetched again until their TTL
+    runs out. Changes are only written to disk by `flush`.
+    """
+
+    def __init__(self, path: str, ttl: float, negative_ttl: float):
+        self.path = path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.entries: dict[str, dict] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                logging.error(f"Error loading resolution cache {path}: {e}")
+
+    def get(self, page_url: str) -> tuple[bool, str | None]:
+        """Return (hit, video_url)."""
+        entry = self.entries.get(page_url)
+        if entry is None:
+            return False, None
+        ttl = self.ttl if entry["video_url"] else self.negative_ttl
+        if time.time() - entry["at"] > ttl:
+            return False, None
+        return True, entry["video_url"]
+
+    def set(self, page_url: str, video_url: str | None) -> None:
+        with self.lock:
+            self.entries[page_url] = {"video_url": video_url, "at": time.time()}
+            self.dirty = True
+
+    def invalidate(self, page_url: str) -> None:
+        with self.lock:
+            if self.entries.pop(page_url, None) is not None:
+                self.dirty = True
+
+    def flush(self) -> None:
+        """Write the cache if it changed since the last flush. Blocking."""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries, ensure_ascii=False)
+            self.dirty = False
+        try:
+            _write_atomic(self.path, data)
+        except Exception:
+            with self.lock:
+                self.dirty = True
+            raise
+
+
+resolution_cache = ResolutionCache(
+    os.path.join(CACHE_PATH, "resolved_urls.json"),
+    RESOLVE_TTL_HOURS * 3600,
+    RESOLVE_NEGATIVE_TTL_HOURS * 3600,
+)
+
+
+VIDEO_SRC_PATTERN = re.compile(r'<video[^>]*src=[\'"]([^\'"]+)[\'"]')
+
+
+async def _scan_video_src(response: aiohttp.ClientResponse) -> str | None:
+    """Read the page only until the <video src> has been seen."""
+    decoder = codecs.getincrementaldecoder(response.charset or "utf-8")("replace")
+    html_content = ""
+    searched = 0
+    async for chunk in response.content.iter_chunked(16384):
+        html_content += decoder.decode(chunk)
+        # rescan a little of the previous text, a tag may straddle chunks
+        match = VIDEO_SRC_PATTERN.search(html_content, max(0, searched - 4096))
+        if match:
+            return match.group(1)
+        searched = len(html_content)
+    return None
+
+
+@traced("extract_video_url")
+async def extract_video_url(url, session: aiohttp.ClientSession | None = None):
+    hit, video_url = resolution_cache.get(url)
+    current_span().set(cache_hit=hit)
+    metrics.count(f"resolution_cache.{'hit' if hit else 'miss'}")
+    if hit:
+        return video_url
+    try:
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await extract_video_url(url, session)
+        async with session.get(url) as response:
+            response.raise_for_status()
+            video_url = await _scan_video_src(response)
+        if not video_url:
             logging.error(f"No video tag or src attribute found in {url}")
+            resolution_cache.set(url, None)
             return None
-        video_url = video_src_pattern.group(1)
         if video_url.startswith("/"):
             base_url = "{0.scheme}://{0.netloc}".format(urlparse(url))
             video_url = base_url + video_url
         if not video_url.startswith("http"):
+            resolution_cache.set(url, None)
             return None
+        resolution_cache.set(url, video_url)
         return video_url
 
     except Exception as e:
@@ -113,95 +371,450 @@ async def extract_video_url(url):
         return None
 
 
-async def download_video(video_url, output_path="downloaded_video.mp4"):
-    try:
-        logging.info(f"Downloading video from: {video_url}")
+async def _download_part(
+    video_url: str, part_path: str, session: aiohttp.ClientSession
+) -> None:
+    """Fetch into `part_path`, resuming with a Range request if it exists."""
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset else {}
+    async with session.get(video_url, headers=headers) as response:
+        content_range = response.headers.get("Content-Range", "")
+        total = content_range.rpartition("/")[2]
+        if response.status == 416:
+            if total.isdigit() and int(total) == offset:
+                return
+            os.remove(part_path)
+            raise IOError(f"cannot resume at byte {offset}, restarting")
+        response.raise_for_status()
+        if response.status == 206:
+            logging.info(f"Resuming download at byte {offset}: {video_url}")
+            mode = "ab"
+            expected = int(total) if total.isdigit() else None
+        else:
+            mode = "wb"
+            expected = response.content_length
+        with open(part_path, mode) as f:
+            async for chunk in response.content.iter_chunked(65536):
+                f.write(chunk)
+    size = os.path.getsize(part_path)
+    if expected is not None and size != expected:
+        raise IOError(f"incomplete download: {size}/{expected} bytes")
+
+
+@traced("download_video")
+async def download_video(
+    video_url,
+    output_path="downloaded_video.mp4",
+    session: aiohttp.ClientSession | None = None,
+    retries: int = DOWNLOAD_RETRIES,
+):
+    """
+    Download into a .part file, resuming it after transient errors, and only
+    move it into place once its size matches and it probes as valid media,
+    so `output_path` existing always means a complete clip.
+    """
+    if session is None:
         async with aiohttp.ClientSession() as session:
-            async with session.get(video_url) as response:
-                response.raise_for_status()
-                with open(output_path, "wb") as f:
-                    async for chunk in response.content.iter_chunked(8192):
-                        if chunk:
-                            f.write(chunk)
+            return await download_video(video_url, output_path, session, retries)
+    logging.info(f"Downloading video from: {video_url}")
+    part_path = output_path + ".part"
+    for attempt in range(retries + 1):
+        try:
+            await _download_part(video_url, part_path, session)
+            break
+        except Exception as e:
+            logging.error(
+                f"Error during download (attempt {attempt+1}/{retries+1}): {e}"
+            )
+            if attempt == retries:
+                return False
+            await asyncio.sleep(2**attempt)
+    info = None
+    if DOWNLOAD_VERIFY:
+        try:
+            info = await asyncio.to_thread(probe_media, part_path)
+            if not info["duration"] > 0:
+                raise ValueError("zero duration")
+        except Exception as e:
+            logging.error(f"Downloaded file is not valid media: {e} in {video_url}")
+            os.remove(part_path)
+            return False
+    os.replace(part_path, output_path)
+    if info is not None:
+        await asyncio.to_thread(media_info_cache.put, output_path, info)
+    size = os.path.getsize(output_path)
+    current_span().set(bytes=size)
+    metrics.count("download.bytes", size)
+    logging.info(f"Video successfully downloaded to: {output_path}")
+    return True
 
-        logging.info(f"Video successfully downloaded to: {output_path}")
-        return True
 
-    except Exception as e:
-        logging.error(f"Error during download: {e}")
-        return False
+def clip_filename(page_url: str) -> str:
+    """Name of the raw clip file in VIDEO_PATH for an outplayed.tv page url."""
+    return hashlib.md5(page_url.encode()).hexdigest() + ".mp4"
 
 
-def get_media_duration(media_path):
+def _parse_frame_rate(rate: str) -> float:
+    num, _, den = rate.partition("/")
+    try:
+        return float(num) / float(den or 1)
+    except (ValueError, ZeroDivisionError):
+        return 0.0
+
+
+# ffprobe only reads headers, a run this long is hung on a broken file
+PROBE_TIMEOUT = 60
+
+
+@traced("probe_media")
+def probe_media(media_path: str) -> dict:
+    """
+    Run ffprobe once and return the fields we care about. Raises
+    subprocess.TimeoutExpired, after killing ffprobe, if it hangs.
+    """
     cmd = [
         "ffprobe",
         "-v",
         "error",
         "-show_entries",
-        "format=duration",
+        "format=duration:stream=codec_type,codec_name,width,height,"
+        "r_frame_rate,sample_rate,channels",
         "-of",
         "json",
         media_path,
     ]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=PROBE_TIMEOUT)
+    data = json.loads(result.stdout)
+    info: dict = {"duration": float(data["format"]["duration"])}
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") == "video" and "video_codec" not in info:
+            info["video_codec"] = stream.get("codec_name")
+            info["width"] = stream.get("width")
+            info["height"] = stream.get("height")
+            info["fps"] = _parse_frame_rate(stream.get("r_frame_rate", "0/1"))
+        elif stream.get("codec_type") == "audio" and "audio_codec" not in info:
+            info["audio_codec"] = stream.get("codec_name")
+            info["sample_rate"] = int(stream.get("sample_rate") or 0)
+            info["channels"] = stream.get("channels")
+    return info
+
+
+class MediaInfoCache:
+    """
+    Persistent media metadata keyed by absolute path, size and mtime.
+
+    Entries are invalidated as soon as the file on disk changes. Besides the
+    ffprobe fields, callers can attach extra fields (e.g. loudness stats) with
+    `update`, which are dropped together with the entry. Changes are only
+    written to disk by `flush`.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.entries: dict[str, dict] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                logging.error(f"Error loading media info cache {path}: {e}")
+
+    @staticmethod
+    def _identity(media_path: str) -> tuple[str, int, int]:
+        st = os.stat(media_path)
+        return os.path.abspath(media_path), st.st_size, st.st_mtime_ns
+
+    def flush(self) -> None:
+        """Write the cache if it changed since the last flush. Blocking."""
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.entries, ensure_ascii=False)
+            self.dirty = False
+        try:
+            _write_atomic(self.path, data)
+        except Exception:
+            with self.lock:
+                self.dirty = True
+            raise
+
+    def _lookup(self, key: str, size: int, mtime: int) -> dict | None:
+        entry = self.entries.get(key)
+        if entry and entry["size"] == size and entry["mtime"] == mtime:
+            return entry
+        return None
+
+    def get(self, media_path: str) -> dict:
+        key, size, mtime = self._identity(media_path)
+        with self.lock:
+            entry = self._lookup(key, size, mtime)
+            if entry is not None:
+                return dict(entry)
+        info = probe_media(media_path)
+        entry = {"size": size, "mtime": mtime, **info}
+        with self.lock:
+            self.entries[key] = entry
+            self.dirty = True
+        return dict(entry)
+
+    def put(self, media_path: str, info: dict) -> None:
+        """Store metadata that was probed under another name (e.g. a .part)."""
+        key, size, mtime = self._identity(media_path)
+        with self.lock:
+            self.entries[key] = {"size": size, "mtime": mtime, **info}
+            self.dirty = True
+
+    def update(self, media_path: str, **fields) -> None:
+        key, size, mtime = self._identity(media_path)
+        with self.lock:
+            entry = self._lookup(key, size, mtime)
+            if entry is None:
+                return
+            entry.update(fields)
+            self.dirty = True
+
+
+media_info_cache = MediaInfoCache(os.path.join(CACHE_PATH, "media_info.json"))
+
+
+async def flush_caches() -> None:
+    """Persist the changed lookup caches off the event loop."""
+    await asyncio.to_thread(resolution_cache.flush)
+    await asyncio.to_thread(media_info_cache.flush)
+
+
+def get_media_info(media_path: str) -> dict:
+    return media_info_cache.get(media_path)
+
+
+def get_media_duration(media_path):
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        data = json.loads(result.stdout)
-        return float(data["format"]["duration"])
+        return float(get_media_info(media_path)["duration"])
     except Exception as e:
         logging.error(f"Error getting media {media_path} duration: {e}")
         return 0.0
 
 
-def process_video(fn: str, text: str) -> None:
-    """Process video by adding text overlay and normalizing audio."""
+LOUDNORM_I = -16.0
+LOUDNORM_TP = -1.5
+LOUDNORM_LRA = 11.0
+LOUDNORM_FILTER = f"loudnorm=I={LOUDNORM_I}:TP={LOUDNORM_TP}:LRA={LOUDNORM_LRA}"
+
+
+async def measure_loudness(media_path: str) -> dict | None:
+    """
+    Measure integrated loudness, true peak, LRA and threshold of a file once
+    and keep them in the media info cache. Returns None without audio.
+    """
+    info = await asyncio.to_thread(get_media_info, media_path)
+    if "loudness" in info:
+        return info["loudness"]
+    if "audio_codec" not in info:
+        return None
     args = [
         "ffmpeg",
-        "-hwaccel",
-        "cuda",
+        "-hide_banner",
+        "-nostats",
+        "-i",
+        media_path,
+        "-vn",
+        "-af",
+        f"{LOUDNORM_FILTER}:print_format=json",
+        "-f",
+        "null",
+        "-",
+    ]
+    result = await run_ffmpeg(args)
+    output = result.stderr
+    data = json.loads(output[output.rindex("{") : output.rindex("}") + 1])
+    loudness = {
+        key: float(data[key])
+        for key in ("input_i", "input_tp", "input_lra", "input_thresh")
+    }
+    await asyncio.to_thread(media_info_cache.update, media_path, loudness=loudness)
+    return loudness
+
+
+async def loudness_filter(media_path: str) -> str:
+    """
+    Linear loudness normalization from the stored measurements.
+
+    The gain brings the integrated loudness to the target unless that would
+    push the true peak over its ceiling, which is what loudnorm's linear mode
+    does, but as a plain volume filter without loudnorm's 192kHz resampling.
+    Falls back to single-pass loudnorm if the file cannot be measured.
+    """
+    try:
+        loudness = await measure_loudness(media_path)
+    except Exception as e:
+        logging.error(f"Error measuring loudness of {media_path}: {e}")
+        return LOUDNORM_FILTER
+    if loudness is None:
+        return "anull"
+    gain = min(LOUDNORM_I - loudness["input_i"], LOUDNORM_TP - loudness["input_tp"])
+    if not math.isfinite(gain):
+        gain = 0.0
+    return f"volume={gain:.2f}dB"
+
+
+def _overlay_filter(text: str) -> str:
+    return f"scale=1920:1080,setsar=1,drawtext=text='{text}':fontfile={FONT_FILE_PATH}:font={FONT_NAME}:fontcolor=white:fontsize=64:borderw=4:bordercolor=black:x=20:y=20"
+
+
+def _process_video_args(
+    input_path: str, text: str, output_path: str, audio_filter: str
+) -> list[str]:
+    if MERGE_MODE == "copy":
+        # segments are already in the final codec with identical parameters,
+        # so merge_videos_with_bgm can stream-copy them
+        encoder = get_encoder_backend("hevc")
+        video_args = [
+            *encoder.video_args("hevc", 28, "medium"),
+            "-tag:v",
+            "hvc1",
+            "-video_track_timescale",
+            "30000",
+        ]
+    else:
+        encoder = get_encoder_backend("h264")
+        video_args = encoder.video_args("h264", 23, "fast")
+    return [
+        "ffmpeg",
+        *encoder.input_args(),
         "-i",
-        os.path.join(VIDEO_PATH, fn),
+        input_path,
         "-y",
         "-vf",
-        f"scale=1920:1080,drawtext=text='{text}':fontfile={FONT_FILE_PATH}:font={FONT_NAME}:fontcolor=white:fontsize=64:borderw=4:bordercolor=black:x=20:y=20",
+        _overlay_filter(text) + encoder.filter_suffix,
         "-af",
-        "loudnorm=I=-16:TP=-1.5:LRA=11",
-        "-c:v",
-        "h264_nvenc",
-        "-preset",
-        "fast",
-        "-rc",
-        "vbr",
-        "-cq",
-        "23",
-        "-b:v",
-        "0",
+        audio_filter,
+        *video_args,
         "-r",
         "30",
+        "-c:a",
+        "aac",
         "-ar",
         "48000",
         "-ac",
         "2",
         "-y",
-        os.path.join(OUTPUT_VIDEO_PATH, "tmp", fn),
+        output_path,
     ]
-    subprocess.run(args, check=True)
 
 
-def merge_audios(
-    output_path: str,
-    minimum_duration: float = 120,
-):
-    """Merge multiple audio files into one file."""
-    fns = [fn for fn in os.listdir(AUDIO_PATH)]
-    for fn in fns:
-        if fn.endswith("_standardized.m4a"):
+def processed_clip_name(fn: str, text: str) -> str:
+    """
+    Name of the processed clip in OUTPUT_VIDEO_PATH/tmp.
+
+    The name hashes the source clip identity, the overlay text, the font and
+    every encode parameter, so each distinct variant is encoded once and
+    shared by all commands.
+    """
+    font_identity = [0, 0]
+    if os.path.exists(FONT_FILE_PATH):
+        st = os.stat(FONT_FILE_PATH)
+        font_identity = [st.st_size, st.st_mtime_ns]
+    key = [
+        fn,
+        os.path.getsize(os.path.join(VIDEO_PATH, fn)),
+        font_identity,
+        # the gain is derived from the source clip, which is already part of the key
+        _process_video_args("", text, "", "volume=<linear loudnorm>"),
+    ]
+    digest = hashlib.sha256(json.dumps(key, ensure_ascii=False).encode()).hexdigest()
+    return f"{os.path.splitext(fn)[0]}-{digest[:16]}.mp4"
+
+
+@traced("process_video")
+async def process_video(fn: str, text: str, on_progress=None) -> str:
+    """
+    Process video by adding text overlay and normalizing audio.
+    Returns the processed clip name, reusing a cached encode if present.
+    """
+    processed_fn = await asyncio.to_thread(processed_clip_name, fn, text)
+    output_path = os.path.join(OUTPUT_VIDEO_PATH, "tmp", processed_fn)
+    cache_hit = os.path.exists(output_path)
+    current_span().set(fn=fn, cache_hit=cache_hit)
+    if cache_hit:
+        logging.info(f"processed clip cache hit: {fn} -> {processed_fn}")
+        storage.use(output_path, hit=True)
+        return processed_fn
+    logging.info(f"processed clip cache miss: {fn} -> {processed_fn}")
+
+    async def encode():
+        tmp_path = output_path.removesuffix(".mp4") + ".part.mp4"
+        input_path = os.path.join(VIDEO_PATH, fn)
+        try:
+            async with encode_slots:
+                audio_filter = await loudness_filter(input_path)
+                args = _process_video_args(input_path, text, tmp_path, audio_filter)
+                await run_ffmpeg(args, on_progress)
+            os.replace(tmp_path, output_path)
+        finally:
+            # a failed or cancelled encode must not leave its partial output
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # another job may be encoding the same variant right now
+    await encode_inflight.run(processed_fn, encode)
+    storage.use(output_path, hit=False)
+    return processed_fn
+
+
+BGM_CATALOG_PATH = os.path.join(CACHE_PATH, "bgm_catalog.json")
+BGM_SUFFIX = "_normalized.m4a"
+# concurrent jobs must not transcode the same track or rewrite the catalog at once
+bgm_ingest_lock = asyncio.Lock()
+
+
+async def ingest_bgm() -> dict[str, dict]:
+    """
+    Bring every new file in AUDIO_PATH into the BGM catalog.
+
+    New tracks are measured, transcoded once to loudness-normalized 48kHz
+    stereo AAC (replacing the original) and recorded with their duration and
+    loudness, so playlists can be built and stream-copied without probing.
+    """
+    async with bgm_ingest_lock:
+        return await _ingest_bgm()
+
+
+async def _ingest_bgm() -> dict[str, dict]:
+    catalog: dict[str, dict] = {}
+    if os.path.exists(BGM_CATALOG_PATH):
+        with open(BGM_CATALOG_PATH, "r", encoding="utf-8") as f:
+            catalog = json.load(f)
+    fns = set(os.listdir(AUDIO_PATH))
+    changed = False
+    for fn in list(catalog):
+        if fn not in fns:
+            del catalog[fn]
+            changed = True
+    for fn in sorted(fns):
+        if fn in catalog or fn.endswith(".part" + BGM_SUFFIX):
             continue
+        src_path = os.path.join(AUDIO_PATH, fn)
         file_base, _ = os.path.splitext(fn)
+        file_base = file_base.removesuffix("_normalized").removesuffix("_standardized")
+        out_fn = file_base + BGM_SUFFIX
+        out_path = os.path.join(AUDIO_PATH, out_fn)
+        tmp_path = os.path.join(AUDIO_PATH, file_base + ".part" + BGM_SUFFIX)
+        audio_filter = await loudness_filter(src_path)
+        try:
+            loudness = (await asyncio.to_thread(get_media_info, src_path)).get(
+                "loudness"
+            )
+        except Exception:
+            loudness = None
         args = [
             "ffmpeg",
             "-i",
-            os.path.join(AUDIO_PATH, fn),
+            src_path,
             "-vn",
+            "-af",
+            audio_filter,
             "-ar",
             "48000",
             "-ac",
@@ -211,24 +824,77 @@ def merge_audios(
             "-b:a",
             "192k",
             "-y",
-            os.path.join(AUDIO_PATH, f"{file_base}_standardized.m4a"),
+            tmp_path,
         ]
-        subprocess.run(args, check=True)
-        os.remove(os.path.join(AUDIO_PATH, fn))
-    fns = [fn for fn in os.listdir(AUDIO_PATH)]
-    random.shuffle(fns)
+        try:
+            await run_ffmpeg(args)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            logging.error(f"Error ingesting bgm {fn}: {e}")
+            continue
+        os.replace(tmp_path, out_path)
+        if src_path != out_path:
+            os.remove(src_path)
+        duration = await asyncio.to_thread(get_media_duration, out_path)
+        if duration == 0.0:
+            logging.error(f"Error getting duration for {out_fn}")
+            continue
+        catalog[out_fn] = {"duration": duration, "loudness": loudness}
+        changed = True
+        logging.info(f"ingested bgm {fn} -> {out_fn} ({duration:.1f}s)")
+    if changed:
+        tmp_path = BGM_CATALOG_PATH + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(catalog, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, BGM_CATALOG_PATH)
+    return catalog
+
+
+def pack_playlist(
+    catalog: dict[str, dict], minimum_duration: float, seed: int | None = None
+) -> list[str]:
+    """
+    Pick shuffled tracks until `minimum_duration` is covered. The closing
+    track is the shortest remaining one that still covers the target, and the
+    catalog is cycled if it is shorter than the target.
+    """
+    rng = random.Random(seed)
+    fns = sorted(catalog)
+    if not fns:
+        return []
+    playlist: list[str] = []
     current_duration = 0.0
+    while current_duration <= minimum_duration:
+        remaining = fns[:]
+        rng.shuffle(remaining)
+        while remaining and current_duration <= minimum_duration:
+            missing = minimum_duration - current_duration
+            fn = remaining[0]
+            if playlist and catalog[fn]["duration"] > missing:
+                # closing track: overshoot the target as little as possible
+                fn = min(
+                    (fn for fn in remaining if catalog[fn]["duration"] > missing),
+                    key=lambda fn: catalog[fn]["duration"],
+                )
+            remaining.remove(fn)
+            playlist.append(fn)
+            current_duration += catalog[fn]["duration"]
+    return playlist
+
+
+@traced("merge_audios")
+async def merge_audios(
+    output_path: str,
+    minimum_duration: float = 120,
+    seed: int | None = None,
+):
+    """Merge catalogued background tracks into one file without re-encoding."""
+    catalog = await ingest_bgm()
+    playlist = pack_playlist(catalog, minimum_duration, seed)
+    current_duration = sum(catalog[fn]["duration"] for fn in playlist)
+    logging.info(f"total audio duration: {current_duration}")
     with tempfile.NamedTemporaryFile(mode="w", suffix=".txt") as f:
-        for fn in fns:
-            duration = get_media_duration(os.path.join(AUDIO_PATH, fn))
-            if duration == 0.0:
-                logging.error(f"Error getting duration for {fn}")
-                continue
+        for fn in playlist:
             f.write(f"file '{os.path.abspath(os.path.join(AUDIO_PATH, fn))}'\n")
-            current_duration += duration
-            if current_duration > minimum_duration:
-                break
-        logging.info(f"total audio duration: {current_duration}")
         f.flush()
         args = [
             "ffmpeg",
@@ -239,20 +905,23 @@ def merge_audios(
             "0",
             "-i",
             f.name,
-            "-af",
-            "loudnorm=I=-16:TP=-1.5:LRA=11",
+            "-c",
+            "copy",
             output_path,
         ]
-        subprocess.run(args, check=True)
+        await run_ffmpeg(args)
+    storage.use(output_path)
     return os.path.abspath(output_path)
 
 
-def merge_videos_with_bgm(
+@traced("merge_videos_with_bgm")
+async def merge_videos_with_bgm(
     fns: list[str],
     output_path: str,
     audio_path: str = "./assets/bili1.m4a",
     video_volume: float = 1.0,
     bgm_volume: float = 0.25,
+    on_progress=None,
 ) -> str:
     """Merge multiple videos into one file and add background music in one step."""
     with tempfile.NamedTemporaryFile(mode="w", suffix=".txt") as f:
@@ -266,12 +935,21 @@ def merge_videos_with_bgm(
         filter_complex = (
             f"[0:a]volume={video_volume}[v_audio];"
             f"[1:a]volume={bgm_volume}[bgm_audio];"
-            "[v_audio][bgm_audio]amix=inputs=2:duration=shortest"
+            "[v_audio][bgm_audio]amix=inputs=2:duration=shortest[a_out]"
         )
+        input_args: list[str] = []
+        if MERGE_MODE == "copy":
+            # only the mixed audio track is encoded, the video runs at disk speed
+            video_args = ["-c:v", "copy", "-movflags", "+faststart"]
+        else:
+            encoder = get_encoder_backend("hevc")
+            input_args = encoder.input_args()
+            video_args = encoder.video_args("hevc", 28, "medium")
+            if encoder.filter_suffix:
+                video_args += ["-vf", encoder.filter_suffix.lstrip(",")]
         args = [
             "ffmpeg",
-            "-hwaccel",
-            "cuda",
+            *input_args,
             "-y",
             "-f",
             "concat",
@@ -283,19 +961,108 @@ def merge_videos_with_bgm(
             audio_path,
             "-filter_complex",
             filter_complex,
-            "-c:v",
-            "hevc_nvenc",
-            "-preset",
-            "p4",
-            "-cq",
-            "28",
+            "-map",
+            "0:v",
+            "-map",
+            "[a_out]",
+            *video_args,
             "-c:a",
             "aac",
             "-b:a",
             "128k",
             output_path,
         ]
-        subprocess.run(args, check=True)
+        await run_ffmpeg(args, on_progress)
+    return os.path.abspath(output_path)
+
+
+@traced("render_graph")
+async def render_graph(
+    fns: list[str],
+    texts: list[str],
+    output_path: str,
+    video_volume: float = 1.0,
+    bgm_volume: float = 0.25,
+    seed: int | None = None,
+    on_progress=None,
+) -> str:
+    """
+    Render a whole compilation in one ffmpeg run: every clip is scaled,
+    captioned and loudness-normalized inside one filter graph, concatenated
+    and mixed with the BGM playlist, so no intermediate files are written.
+    """
+    input_paths = [os.path.join(VIDEO_PATH, fn) for fn in fns]
+    infos = await asyncio.gather(
+        *(asyncio.to_thread(get_media_info, path) for path in input_paths)
+    )
+
+    async def measured_filter(input_path: str) -> str:
+        # each measurement is a full ffmpeg decode, bounded like the encodes
+        async with encode_slots:
+            return await loudness_filter(input_path)
+
+    audio_filters = await asyncio.gather(*(measured_filter(p) for p in input_paths))
+    total_duration = sum(info["duration"] for info in infos)
+    catalog = await ingest_bgm()
+    playlist = pack_playlist(catalog, total_duration, seed)
+    encoder = get_encoder_backend("hevc")
+    input_args = encoder.device_args()
+    filters = []
+    for i, (path, text, info, audio_filter) in enumerate(
+        zip(input_paths, texts, infos, audio_filters)
+    ):
+        input_args += [*encoder.decode_args(), "-i", path]
+        filters.append(f"[{i}:v]{_overlay_filter(text)},fps=30[v{i}]")
+        if "audio_codec" in info:
+            audio_source = f"[{i}:a]{audio_filter},aresample=48000"
+        else:
+            # concat needs an audio stream for every segment
+            audio_source = (
+                f"anullsrc=r=48000:cl=stereo,atrim=duration={info['duration']}"
+            )
+        filters.append(
+            f"{audio_source},aformat=sample_fmts=fltp:channel_layouts=stereo[a{i}]"
+        )
+    segments = "".join(f"[v{i}][a{i}]" for i in range(len(fns)))
+    filters.append(f"{segments}concat=n={len(fns)}:v=1:a=1[v_cat][a_cat]")
+    filters.append(f"[v_cat]{encoder.filter_suffix.lstrip(',') or 'null'}[v_out]")
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".txt") as f:
+        if playlist:
+            for fn in playlist:
+                f.write(f"file '{os.path.abspath(os.path.join(AUDIO_PATH, fn))}'\n")
+            f.flush()
+            input_args += ["-f", "concat", "-safe", "0", "-i", f.name]
+            filters += [
+                f"[a_cat]volume={video_volume}[v_audio]",
+                f"[{len(fns)}:a]volume={bgm_volume}[bgm_audio]",
+                "[v_audio][bgm_audio]amix=inputs=2:duration=shortest[a_out]",
+            ]
+        else:
+            logging.warning("no bgm available, rendering without background music")
+            filters.append(f"[a_cat]volume={video_volume}[a_out]")
+        args = [
+            "ffmpeg",
+            "-y",
+            *input_args,
+            "-filter_complex",
+            ";".join(filters),
+            "-map",
+            "[v_out]",
+            "-map",
+            "[a_out]",
+            *encoder.video_args("hevc", 28, "medium"),
+            "-tag:v",
+            "hvc1",
+            "-c:a",
+            "aac",
+            "-b:a",
+            "128k",
+            "-movflags",
+            "+faststart",
+            output_path,
+        ]
+        async with encode_slots:
+            await run_ffmpeg(args, on_progress)
     return os.path.abspath(output_path)
 
 
@@ -314,18 +1081,33 @@ def extract_url_with_prefix(text, prefix):
         return ""
 
 
-def create_global_timeline_iterator(data, channels):
-    "return (channel, dt, user, content)"
-    all_entries = []
-    for channel in channels:
-        channel_data = data.get(channel, {})
-        for user, msg in channel_data.items():
-            for timestamp_str, content in msg.items():
-                dt = datetime.datetime.strptime(timestamp_str, "%Y-%m-%d %H:%M:%S")
-                all_entries.append((channel, dt, user, content))
-    sorted_entries = sorted(all_entries, key=lambda x: x[1])
-    for entry in sorted_entries:
-        yield entry
+async def create_global_timeline_iterator(sources, channels, start=None):
+    """
+    Lazily merge per-channel message streams into one timeline of
+    (channel, timestamp, user, content), ties kept in the order of `channels`.
+    `sources(channel, start)` must be an async iterator over the (timestamp,
+    user, content) of a channel sorted by integer timestamp, from `start` on
+    if given.
+    """
+    channels = list(dict.fromkeys(channels))
+    streams = [sources(channel, start) for channel in channels]
+    # one head per channel, ordered by (timestamp, channel position)
+    heads: list[tuple[int, int, tuple[int, str, str]]] = []
+
+    async def pull(index: int) -> None:
+        entry = await anext(streams[index], None)
+        if entry is not None:
+            heapq.heappush(heads, (entry[0], index, entry))
+
+    try:
+        await asyncio.gather(*(pull(index) for index in range(len(streams))))
+        while heads:
+            timestamp, index, (_, user, content) = heapq.heappop(heads)
+            yield channels[index], timestamp, user, content
+            await pull(index)
+    finally:
+        for stream in streams:
+            await stream.aclose()
 
 
 def cleanup_msg(msg: str) -> str:
@@ -335,88 +1117,3 @@ def cleanup_msg(msg: str) -> str:
     msg = re.sub(r"<@\d+>", "", msg)
     msg = msg.strip()
     return msg
-
-
-def create_cover_image(video_path: str, output_image_path: str) -> str:
-    command = [
-        "ffmpeg",
-        "-i",
-        video_path,
-        "-frames:v",
-        "1",
-        "-f",
-        "image2pipe",
-        "-vcodec",
-        "png",
-        "-",
-    ]
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout_data, _ = process.communicate()
-    image_stream = io.BytesIO(stdout_data)
-    img = Image.open(image_stream).convert("RGB")
-    draw = ImageDraw.Draw(img)
-
-    text1 = "Apex"
-    text2 = "精彩时刻"
-    text3 = datetime.datetime.now().strftime("%m/%d/%y")
-    color1 = (255, 223, 0)
-    color2 = (255, 69, 0)
-    color3 = (0, 150, 0)
-    font1 = ImageFont.truetype(FONT_FILE_PATH, 350)
-    font2 = ImageFont.truetype(FONT_FILE_PATH, 200)
-    font3 = ImageFont.truetype(FONT_FILE_PATH, 150)
-    img_width, img_height = img.size
-    padding_x = 40
-    padding_y = 20
-
-    text1_bbox = draw.textbbox((0, 0), text1, font=font1)
-    text1_width = text1_bbox[2] - text1_bbox[0]
-    text1_height = text1_bbox[3] - text1_bbox[1]
-    text1_x = (img_width - text1_width) / 2
-    text1_y = img_height * 0.0
-
-    text2_bbox = draw.textbbox((0, 0), text2, font=font2)
-    text2_width = text2_bbox[2] - text2_bbox[0]
-    text2_height = text2_bbox[3] - text2_bbox[1]
-    text2_x = (img_width - text2_width) / 2
-    text2_y = text1_y + text1_height + 100
-
-    text3_bbox = draw.textbbox((0, 0), text3, font=font3)
-    text3_width = text3_bbox[2] - text3_bbox[0]
-    text3_height = text3_bbox[3] - text3_bbox[1]
-    text3_x = (img_width - text3_width) / 2
-    text3_y = text2_y + text2_height + 100
-
-    # rect3_x1 = text3_x - padding_x
-    # rect3_y1 = text3_y
-    # rect3_x2 = text3_x + text3_width + padding_x
-    # rect3_y2 = text3_y + text3_height + padding_y * 3
-
-    # draw.rectangle([rect3_x1, rect3_y1, rect3_x2, rect3_y2], fill=(0, 0, 0, 180))
-
-    draw.text(
-        (text1_x, text1_y),
-        text1,
-        fill=color1,
-        font=font1,
-        stroke_width=20,
-        stroke_fill=(0, 0, 0),
-    )
-    draw.text(
-        (text2_x, text2_y),
-        text2,
-        fill=color2,
-        font=font2,
-        stroke_width=20,
-        stroke_fill=(0, 0, 0),
-    )
-    draw.text(
-        (text3_x, text3_y),
-        text3,
-        fill=color3,
-        font=font3,
-        stroke_width=10,
-        stroke_fill=(0, 0, 0),
-    )
-    img.save(output_image_path, format="JPEG", quality=90, optimize=True)
-    return output_image_path
@@ -2,7 +2,13 @@
 
 # taken from https://developers.google.com/youtube/v3/guides/uploading_a_video
 
+import asyncio
+import functools
+import hashlib
+import json
+import os
 import random
+import threading
 import time
 
 import httplib2
@@ -13,27 +19,116 @@ from oauth2client.client import flow_from_clientsecrets
 from oauth2client.file import Storage
 from oauth2client.tools import run_flow
 
+from config import *
 from logger import logger
 
 httplib2.RETRIES = 1
 MAX_RETRIES = 10
 RETRIABLE_EXCEPTIONS = (httplib2.HttpLib2Error, IOError)
 RETRIABLE_STATUS_CODES = [500, 502, 503, 504]
+# the upload session is gone and the upload has to start over
+EXPIRED_STATUS_CODES = [404, 410]
 CLIENT_SECRETS_FILE = "client_secrets.json"
 YOUTUBE_UPLOAD_SCOPE = "https://www.googleapis.com/auth/youtube.upload"
 YOUTUBE_API_SERVICE_NAME = "youtube"
 YOUTUBE_API_VERSION = "v3"
+UPLOAD_SESSIONS_PATH = os.path.join(CACHE_PATH, "youtube_uploads.json")
+PENDING_UPLOADS_PATH = os.path.join(CACHE_PATH, "youtube_pending.json")
 
 
-def resumable_upload(insert_request):
+_json_lock = threading.Lock()
+
+
+def _load_json(path: str) -> dict[str, dict]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading {path}: {e}")
+        return {}
+
+
+def _update_json(path: str, key: str, value: dict | None) -> None:
+    # concurrent uploads update the same files from worker threads
+    with _json_lock:
+        data = _load_json(path)
+        if value is None:
+            data.pop(key, None)
+        else:
+            data[key] = value
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+        os.replace(tmp_path, path)
+
+
+def session_key(video_path: str, title: str) -> str:
+    """
+    Identify an upload by file content rather than mtime, so a compilation
+    that was rendered again after a restart still resumes its session.
+    """
+    size = os.path.getsize(video_path)
+    digest = hashlib.md5(f"{size}|{title}".encode())
+    with open(video_path, "rb") as f:
+        digest.update(f.read(1 << 20))
+        f.seek(max(size - (1 << 20), 0))
+        digest.update(f.read(1 << 20))
+    return f"{os.path.abspath(video_path)}|{digest.hexdigest()}"
+
+
+def _query_progress(insert_request, uri: str) -> tuple[int, dict | None]:
+    """
+    Ask the server how much of a saved upload session it has received.
+    Returns (next offset, None), or (size, response) if the upload already
+    completed. Raises HttpError if the session is gone.
+    """
+    size = insert_request.resumable.size()
+    resp, content = insert_request.http.request(
+        uri,
+        "PUT",
+        headers={"Content-Range": f"bytes */{size}", "Content-Length": "0"},
+    )
+    if resp.status in (200, 201):
+        return size, json.loads(content)
+    if resp.status != 308:
+        raise HttpError(resp, content, uri=uri)
+    if "range" not in resp:
+        return 0, None
+    return int(resp["range"].split("-")[1]) + 1, None
+
+
+async def resumable_upload(insert_request, key: str, on_progress=None):
+    """
+    Upload chunk by chunk, saving the session URI and offset after every
+    chunk. A saved session is resumed from the offset the server confirms.
+    `on_progress(sent, total, bytes_per_second)` is called after each chunk.
+    """
+    session = await asyncio.to_thread(_load_json, UPLOAD_SESSIONS_PATH)
+    session = session.get(key)
+    total = insert_request.resumable.size()
+    start_offset = insert_request.resumable_progress
+    started = time.monotonic()
     response = None
-    error = None
     retry = 0
     while response is None:
+        error = None
         try:
-            logger.info("Uploading file...")
-            status, response = insert_request.next_chunk()
+            if session is not None and insert_request.resumable_uri is None:
+                offset, response = await asyncio.to_thread(
+                    _query_progress, insert_request, session["uri"]
+                )
+                logger.info(f"Resuming upload at byte {offset}")
+                insert_request.resumable_uri = session["uri"]
+                insert_request.resumable_progress = offset
+                start_offset = offset
+                started = time.monotonic()
+            if response is None:
+                logger.info("Uploading file...")
+                status, response = await asyncio.to_thread(insert_request.next_chunk)
             if response is not None:
+                await asyncio.to_thread(_update_json, UPLOAD_SESSIONS_PATH, key, None)
                 if "id" in response:
                     logger.info(
                         "Video id '%s' was successfully uploaded." % response["id"]
@@ -43,7 +138,30 @@ def resumable_upload(insert_request):
                     raise Exception(
                         "The upload failed with an unexpected response: %s" % response
                     )
+            session = {
+                "uri": insert_request.resumable_uri,
+                "offset": insert_request.resumable_progress,
+            }
+            await asyncio.to_thread(_update_json, UPLOAD_SESSIONS_PATH, key, session)
+            retry = 0
+            sent = status.resumable_progress
+            rate = (sent - start_offset) / max(time.monotonic() - started, 1e-6)
+            logger.info(
+                f"Uploaded {sent}/{total} bytes ({rate / 1024 / 1024:.2f} MiB/s)"
+            )
+            if on_progress is not None:
+                on_progress(sent, total, rate)
         except HttpError as e:
+            if e.resp.status in EXPIRED_STATUS_CODES and session is not None:
+                logger.warning("Upload session expired, starting over")
+                await asyncio.to_thread(_update_json, UPLOAD_SESSIONS_PATH, key, None)
+                session = None
+                # a request without a session URI starts a new session
+                insert_request.resumable_uri = None
+                insert_request.resumable_progress = 0
+                start_offset = 0
+                started = time.monotonic()
+                continue
             if e.resp.status in RETRIABLE_STATUS_CODES:
                 error = "A retriable HTTP error %d occurred:\n%s" % (
                     e.resp.status,
@@ -63,28 +181,37 @@ def resumable_upload(insert_request):
             max_sleep = 2**retry
             sleep_seconds = random.random() * max_sleep
             logger.info("Sleeping %f seconds and then retrying..." % sleep_seconds)
-            time.sleep(sleep_seconds)
+            await asyncio.sleep(sleep_seconds)
 
 
+@functools.cache
 def get_credentials():
-    flow = flow_from_clientsecrets("client_secrets.json", scope=YOUTUBE_UPLOAD_SCOPE)
+    """Authorize once, the credentials are shared by every upload."""
+    flow = flow_from_clientsecrets(CLIENT_SECRETS_FILE, scope=YOUTUBE_UPLOAD_SCOPE)
     storage = Storage("youtube-oauth2.json")
     credentials = storage.get()
     if credentials is None or credentials.invalid:
         credentials = run_flow(flow, storage)
-    youtube = build(
+    logger.info("YouTube login check passed")
+    return credentials
+
+
+def build_client():
+    """
+    A client with its own connection for one upload, as httplib2.Http is not
+    thread-safe and several uploads may run at once.
+    """
+    return build(
         YOUTUBE_API_SERVICE_NAME,
         YOUTUBE_API_VERSION,
-        http=credentials.authorize(httplib2.Http()),
+        http=get_credentials().authorize(httplib2.Http()),
         cache_discovery=False,
     )
-    logger.info("YouTube login check passed")
-    return youtube
 
 
-def upload_video(video_path: str, image_path: str, title: str):
+async def _upload_video(video_path: str, image_path: str, title: str, on_progress):
     logger.info("Uploading video...")
-    youtube = get_credentials()
+    youtube = await asyncio.to_thread(build_client)
     body = dict(
         snippet=dict(
             title=title,
@@ -96,16 +223,62 @@ def upload_video(video_path: str, image_path: str, title: str):
     insert_request = youtube.videos().insert(
         part=",".join(body.keys()),
         body=body,
-        media_body=MediaFileUpload(video_path, chunksize=-1, resumable=True),
-    )
-    video_id = resumable_upload(insert_request)
-    request = youtube.thumbnails().set(
-        videoId=video_id,
-        media_body=MediaFileUpload(image_path, chunksize=-1, resumable=True),
+        media_body=MediaFileUpload(
+            video_path, chunksize=YOUTUBE_CHUNK_SIZE, resumable=True
+        ),
     )
-    response = request.execute()
-    logger.info("Thumbnail set successfully. Response: %s", response)
+    key = await asyncio.to_thread(session_key, video_path, title)
+    video_id = await resumable_upload(insert_request, key, on_progress)
+    # a resumed upload's cover may have been evicted in the meantime
+    if os.path.exists(image_path):
+        request = youtube.thumbnails().set(
+            videoId=video_id,
+            media_body=MediaFileUpload(image_path, chunksize=-1, resumable=True),
+        )
+        response = await asyncio.to_thread(request.execute)
+        logger.info("Thumbnail set successfully. Response: %s", response)
     return f"https://youtu.be/{video_id}"
 
 
+async def upload_video(
+    video_path: str,
+    image_path: str,
+    title: str,
+    on_progress=None,
+    channel_id: int | None = None,
+):
+    """
+    Upload a video with its thumbnail. The upload stays recorded as pending
+    until it succeeds or fails for good, so one interrupted by a restart is
+    listed by `pending_uploads` and resumes its session when run again.
+    `channel_id` is kept with it to report the result to.
+    """
+    pending = {
+        "video_path": video_path,
+        "image_path": image_path,
+        "title": title,
+        "channel_id": channel_id,
+    }
+    await asyncio.to_thread(_update_json, PENDING_UPLOADS_PATH, video_path, pending)
+    try:
+        url = await _upload_video(video_path, image_path, title, on_progress)
+    except Exception:
+        await asyncio.to_thread(_update_json, PENDING_UPLOADS_PATH, video_path, None)
+        raise
+    await asyncio.to_thread(_update_json, PENDING_UPLOADS_PATH, video_path, None)
+    return url
+
+
+def pending_uploads() -> list[dict]:
+    """Uploads interrupted by a restart whose files are still there."""
+    uploads = []
+    for video_path, upload in _load_json(PENDING_UPLOADS_PATH).items():
+        if os.path.exists(video_path):
+            uploads.append(upload)
+        else:
+            logger.warning(f"Dropping pending upload of missing {video_path}")
+            _update_json(PENDING_UPLOADS_PATH, video_path, None)
+    return uploads
+
+
 get_credentials()